@@ -1,4 +1,4 @@
-import queue
+import torch
 from threading import Thread
 
 import bartleby.configuration as config
@@ -7,6 +7,10 @@ import bartleby.functions.bartleby_discord as discord_funcs
 import bartleby.functions.bartleby_matrix as matrix_funcs
 import bartleby.classes.matrix_class as matrix
 import bartleby.classes.docx_class as docx
+import bartleby.classes.document_queue_class as document_queue_class
+import bartleby.classes.scheduler_class as scheduler
+import bartleby.classes.model_pool_class as model_pool
+import bartleby.classes.response_queue_class as response_queue_class
 
 def run():
     '''Run bartleby'''
@@ -19,27 +23,57 @@ def run():
 
     logger.info('Directory structure OK')
     logger.info(f'Running in {config.MODE} mode')
-    logger.info(f'Using {config.CPU_threads} CPU threads')
-    logger.info(f'Device map is: {config.device_map}')
 
-    # Make empty dictionaries to hold user and llm class instances
-    users, llms = {}, {}
-    logger.info(f'Initialized empty data structures for users and LLMs')
+    # Size torch's CPU thread pools once for the whole process, before any
+    # model runs. The interop pool can't be resized after it has started.
+    torch.set_num_threads(config.CPU_threads)
+    torch.set_num_interop_threads(config.CPU_interop_threads)
+    logger.info(f'Using {config.CPU_threads} CPU threads and {config.CPU_interop_threads} interop threads')
+    logger.info(f'Devices are: {config.devices}')
+
+    # Make empty dictionary to hold user class instances
+    users = {}
 
     # Make generation queue to take users from the listener
-    # and send them to the LLM when the need a response
-    generation_queue = queue.Queue()
-    response_queue = queue.Queue()
+    # and send them to the LLM in batches when the need a response
+    generation_queue = scheduler.Scheduler(logger)
+
+    # Make notification queue to send messages from the background workers
+    # to the listener: finished document jobs and models which failed to load
+    notification_queue = response_queue_class.Response_queue()
+
+    # Make pool to hold llm class instances, models are loaded
+    # into it in the background
+    llms = model_pool.Model_pool(logger, generation_queue, notification_queue)
+    logger.info(f'Initialized empty data structures for users and LLMs')
+
+    # Start loading any models we want warm at startup
+    llms.prewarm(config.prewarm_models)
+
+    # Make response queue to send users with finished replies from the
+    # LLM to the listener, the listener is woken as soon as one arrives
+    response_queue = response_queue_class.Response_queue()
+
+    # Make stream queue to send partial replies from the
+    # LLM to the listener while they are being generated
+    stream_queue = response_queue_class.Response_queue()
     logger.info('Created queues for LLM IO.')
     
     # Make instance of docx class to generate and upload documents
     docx_instance = docx.Docx()
     logger.info('Docx instance started successfully')
 
-    # Start generator thread for LLMs
-    generator_thread = Thread(target=helper_funcs.generator, args=[llms, generation_queue, response_queue])
-    generator_thread.start()
-    logger.info('Started LLM generator thread')
+    # Start the document workers, they build and upload
+    # documents in the background
+    document_queue = document_queue_class.Document_queue(docx_instance, notification_queue, logger)
+    logger.info(f'Started {config.document_workers} document workers')
+
+    # Start a generator thread for LLMs on each device, so that
+    # models on different devices generate in parallel
+    for device in config.devices:
+        generator_thread = Thread(target=helper_funcs.generator, args=[logger, llms, generation_queue, response_queue, stream_queue, notification_queue, device])
+        generator_thread.start()
+        logger.info(f'Started LLM generator thread for {device}')
 
     if config.MODE == 'matrix':
 
@@ -50,12 +84,14 @@ def run():
 
         # Start the matrix listener
         matrix_listener_thread = Thread(target=matrix_funcs.matrix_listener, args=[
-            docx_instance,
+            document_queue,
             matrix_instance, 
             users, 
             llms, 
             generation_queue, 
             response_queue, 
+            stream_queue,
+            notification_queue,
             logger
         ])
 
@@ -67,11 +103,13 @@ def run():
         # Start the discord listener
         discord_listener_thread = Thread(target=discord_funcs.discord_listener, args=[
             config.bot_token,
-            docx_instance, 
+            document_queue, 
             users, 
             llms, 
             generation_queue, 
             response_queue, 
+            stream_queue,
+            notification_queue,
             logger
         ])
 
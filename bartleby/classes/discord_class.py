@@ -1,25 +1,34 @@
+import asyncio
 import discord
 import time
+import bartleby.configuration as conf
 import textwrap
-from discord.ext import tasks, commands
+from discord.ext import commands
 
 class LLMbot(commands.Bot):
-    '''Custom discord bot class with background task to 
-    check the LLM response queue and post any new generated 
-    responses'''
+    '''Custom discord bot class with background tasks to
+    wait on the LLM response queue and post any new generated
+    responses as soon as they arrive'''
 
-    def __init__(self, logger, response_queue, users, docx_instance, *args, **kwargs):
+    def __init__(self, logger, response_queue, stream_queue, notification_queue, users, llms, document_queue, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # Add logger and LLM's response queue
+        # Add logger and LLM's response and stream queues
         self.logger = logger
         self.response_queue = response_queue
+        self.stream_queue = stream_queue
+
+        # Add queue of messages from the background workers
+        self.notification_queue = notification_queue
 
         # Add list of user class instances
         self.bartleby_users = users
 
-        # Add docx_instance
-        self.docx_instance = docx_instance
+        # Add pool of LLM class instances
+        self.llms = llms
+
+        # Add document queue to run document jobs in the background
+        self.document_queue = document_queue
 
     async def setup_hook(self) -> None:
         
@@ -38,79 +47,234 @@ class LLMbot(commands.Bot):
 
         await self.tree.sync(guild=MY_GUILD)
 
-        # Start the LLM response queue check task to run in the background
-        self.check_response_queue.start()
+        # Start the tasks which post replies as soon as the generator hands
+        # them over. They wait for the bot to log in before posting.
+        self.delivery_tasks = set()
+        self.start_task(self.deliver_responses())
+
+        # And partial replies, if we are streaming
+        if conf.stream_responses == True:
+            self.start_task(self.deliver_partial_responses())
+
+        # And messages from the background workers
+        self.start_task(self.deliver_notifications())
+
+    def start_task(self, coroutine):
+        '''Runs coroutine as a task on the bot's event loop, keeping a
+        reference to it so that it isn't garbage collected while running'''
+
+        task = asyncio.create_task(coroutine)
+        self.delivery_tasks.add(task)
+        task.add_done_callback(self.delivery_tasks.discard)
+
+        return task
 
-    @tasks.loop(seconds=5)  # Frequency with which to run the task
-    async def check_response_queue(self):
+    async def deliver_responses(self):
+        '''Waits on the response queue and posts each finished reply as soon
+        as it arrives. Replies are posted concurrently, so a burst of finished
+        replies doesn't wait on each other.'''
 
-        # Check the response queue
-        if self.response_queue.empty() == False:
+        # Bind the response queue to this event loop so the generator can wake us
+        self.response_queue.attach(asyncio.get_running_loop())
 
-            # Get the next user from the responder queue
-            queued_user = self.response_queue.get()
+        await self.wait_until_ready()
 
-            # Immediately mark this queued user as done so that
-            # the job is not still sitting in the queue while we
-            # generate the response. Otherwise the background task
-            # will pick it up again on the next check.
-            self.response_queue.task_done()
+        while True:
+            queued_user = await self.response_queue.get()
             self.logger.info(f'+{round(time.time() - queued_user.message_time, 2)}s: Responder got {queued_user.user_name} from generator')
 
-            # Get the channel from the channel id in the queued user's message object
-            channel = self.get_channel(queued_user.message_object.channel.id)
+            self.start_task(self.post_response(queued_user))
 
-            # Get the number of not offline users in the channel - this is better than
-            # getting it from the guild because in a server of x members a channel can have
-            # x - n members if it is private
-            online_channel_members = 0
+    async def post_response(self, queued_user):
+        '''Posts a user's complete reply to chat'''
 
-            # Loop on channel members checking status and counting 
-            # members which are not offline
-            for member in channel.members:
-                self.logger.debug(f'{member}: {member.status}')
-                if str(member.status) != 'offline':
-                    online_channel_members += 1
+        # Get the reply text and clear the partial reply so that
+        # any late stream updates are ignored
+        reply = queued_user.replies.popleft()
+        queued_user.partial_reply = None
 
-            # Log result
-            self.logger.debug(f'Not-offline count {online_channel_members}')
+        # If the generation was cancelled, delete the partial reply if
+        # one was posted. One still being sent is deleted once it is.
+        if reply is None:
 
-            # If it is just bartleby and one other user, forgo replies and mentions
-            # and just post bare messages as if it were a DM
-            if online_channel_members <= 2:
+            if queued_user.stream_message is not None:
+                stream_message = queued_user.stream_message
+                queued_user.stream_message = None
 
-                # Make sure we don't hit discord's character limit
-                if len(queued_user.messages[-1]['content']) < 2000:
-                    await channel.send(queued_user.messages[-1]['content'])
+                try:
+                    await stream_message.delete()
 
-                # If the reply is too long, split it up and post the chunks
-                else:
-                    chunks = textwrap.wrap(queued_user.messages[-1]['content'], 2000)
+                except discord.DiscordException as error:
+                    self.logger.error(f'Failed to delete partial reply to {queued_user.user_name}: {error}')
+
+            self.logger.info(f'Took down cancelled reply to {queued_user.user_name}')
+            return
+
+        # Make sure we don't hit discord's character limit
+        if len(reply) < 2000:
+            chunks = [reply]
+
+        # If the reply is too long, split it up and post the chunks
+        else:
+            chunks = textwrap.wrap(reply, 2000)
+
+        try:
+
+            # If the reply was streamed, finish it by editing the placeholder
+            # message with the first chunk
+            if queued_user.stream_message is not None:
+                stream_message = queued_user.stream_message
+                queued_user.stream_message = None
+                await stream_message.edit(content=chunks[0])
+                chunks = chunks[1:]
+
+            for chunk in chunks:
+                _ = await self.send_reply(queued_user, chunk)
+
+        # Don't let one failed post take down delivery for everyone
+        except discord.DiscordException as error:
+            self.logger.error(f'Failed to post reply to {queued_user.user_name}: {error}')
+            return
+
+        # Log response time
+        self.logger.info(f'+{round(time.time() - queued_user.message_time, 2)}s: Posted reply to {queued_user.user_name} in chat')
+
+    async def deliver_partial_responses(self):
+        '''Waits on the stream queue and posts or updates partial replies
+        as they arrive'''
+
+        self.stream_queue.attach(asyncio.get_running_loop())
+
+        await self.wait_until_ready()
+
+        while True:
+
+            # Wait for an update, then collect any others which came in
+            # with it. A user can be on the queue more than once, only
+            # the latest text matters.
+            queued_users = [await self.stream_queue.get()]
+
+            while self.stream_queue.empty() == False:
+
+                queued_user = self.stream_queue.get_nowait()
+
+                if queued_user not in queued_users:
+                    queued_users.append(queued_user)
+
+            for queued_user in queued_users:
 
-                    for chunk in chunks:
-                        await channel.send(chunk)
+                try:
+                    await self.post_partial_response(queued_user)
 
+                except discord.DiscordException as error:
+                    self.logger.error(f'Failed to post partial reply to {queued_user.user_name}: {error}')
 
-            # If there is more than one user, i.e. bartleby + 2 users = 3 members,
-            # use replies
-            if online_channel_members > 2:
+    async def post_partial_response(self, queued_user):
+        '''Posts a placeholder message with a user's partial reply, or
+        updates it if it's already posted'''
 
-                # Make sure we don't hit discord's character limit
-                if len(queued_user.messages[-1]['content']) < 2000:
-                    await queued_user.message_object.reply(queued_user.messages[-1]['content'])
+        # Skip users whose complete reply has already been posted
+        partial_reply = queued_user.partial_reply
+
+        if partial_reply is None:
+            return
+
+        # Make sure we don't hit discord's character limit, the
+        # rest will be posted with the complete reply
+        partial_reply = partial_reply[:1999]
+
+        # Post a placeholder message with the first chunk of the reply
+        if queued_user.stream_message is None:
+            stream_message = await self.send_reply(queued_user, partial_reply)
+
+            # If the complete reply was posted while we were sending
+            # the placeholder, it's not needed
+            if queued_user.partial_reply is None:
+                await stream_message.delete()
+
+            else:
+                queued_user.stream_message = stream_message
+                self.logger.info(f'+{round(time.time() - queued_user.message_time, 2)}s: Posted first chunk of reply to {queued_user.user_name} in chat')
+
+        # Or, update the placeholder
+        else:
+            await queued_user.stream_message.edit(content=partial_reply)
+
+    async def deliver_notifications(self):
+        '''Waits on the notification queue and posts messages
+        from the background workers'''
+
+        self.notification_queue.attach(asyncio.get_running_loop())
+
+        await self.wait_until_ready()
+
+        while True:
+            queued_user, notification, interaction = await self.notification_queue.get()
+            self.start_task(self.post_notification(queued_user, notification, interaction))
+
+    async def post_notification(self, queued_user, notification, interaction):
+        '''Posts a message from the background workers. Messages about jobs
+        started by an interaction get a follow up to it, others reply to the
+        user's last message.'''
+
+        # Exports list many file IDs, make sure we don't hit discord's
+        # character limit by splitting between lines. Lines too long
+        # for one message on their own are hard wrapped.
+        chunks = ['']
+
+        for line in notification.split('\n'):
+            for start in range(0, max(len(line), 1), 1989):
+                piece = line[start:start + 1989]
+
+                if len(chunks[-1]) + len(piece) + 1 > 1990:
+                    chunks.append('')
+
+                chunks[-1] += f'{piece}\n'
+
+        # Discord won't post an empty message
+        chunks = [chunk for chunk in chunks if chunk.strip() != '']
+
+        try:
+            for chunk in chunks:
+                if interaction is not None:
+                    await interaction.followup.send(f'```{chunk}```')
 
-                # If the reply is too long, split it up and post the chunks
                 else:
-                    chunks = textwrap.wrap(queued_user.messages[-1]['content'], 2000)
+                    await self.send_reply(queued_user, f'```{chunk}```')
 
-                    for chunk in chunks:
-                        await queued_user.message_object.reply(chunk)
-            
-            # Log response time
-            self.logger.info(f'+{round(time.time() - queued_user.message_time, 2)}s: Posted reply to {queued_user.user_name} in chat')
+        except discord.DiscordException as error:
+            self.logger.error(f'Failed to post notification to {queued_user.user_name}: {error}')
 
-    # Wait until the bot is logged in to start the LLM response queue check task
-    @check_response_queue.before_loop
-    async def before_my_task(self):
-        
-        await self.wait_until_ready()
\ No newline at end of file
+    async def send_reply(self, queued_user, text):
+        '''Posts text to the channel the user's message came from. Returns
+        the posted message.'''
+
+        # Get the channel from the channel id in the queued user's message object
+        channel = self.get_channel(queued_user.message_object.channel.id)
+
+        # Get the number of not offline users in the channel - this is better than
+        # getting it from the guild because in a server of x members a channel can have
+        # x - n members if it is private
+        online_channel_members = 0
+
+        # Loop on channel members checking status and counting 
+        # members which are not offline
+        for member in channel.members:
+            self.logger.debug(f'{member}: {member.status}')
+            if str(member.status) != 'offline':
+                online_channel_members += 1
+
+        # Log result
+        self.logger.debug(f'Not-offline count {online_channel_members}')
+
+        # If it is just bartleby and one other user, forgo replies and mentions
+        # and just post bare messages as if it were a DM
+        if online_channel_members <= 2:
+            message = await channel.send(text)
+
+        # If there is more than one user, i.e. bartleby + 2 users = 3 members,
+        # use replies
+        else:
+            message = await queued_user.message_object.reply(text)
+
+        return message
\ No newline at end of file
@@ -84,11 +84,12 @@ class Document_commands(commands.Cog):
         # If they have, make the document
         if self.bot.bartleby_users[user_name].gdrive_folder_id != None:
             
-            # Make the document
-            self.bot.docx_instance.generate(self.bot.bartleby_users[user_name], 1, None)
+            # Queue the document, the file ID is posted as
+            # a follow up to the interaction when it's done
+            result = self.bot.document_queue.submit(self.bot.bartleby_users[user_name], 1, None, interaction)
             
             # Post the reply and log the interaction
-            await interaction.response.send_message(f'```Document generated```')
+            await interaction.response.send_message(f'```{result}```')
             self.logger.debug(f'Got make docx command from: {user_name}')
 
         # If they have not set a gdrive folder id, ask them to set one
@@ -97,35 +98,3 @@ class Document_commands(commands.Cog):
 
             await interaction.response.send_message(f'```Please set a gdrive folder generating a document```')
             self.logger.debug(f'Got make docx command without gdrive folder id from: {user_name}')
-
-    # # Context menu command to generate document via left click on message
-    # @app_commands.context_menu(name='Save to gdrive')
-    # async def save_message(self, interaction: discord.Interaction, message: discord.Message):
-
-    #     # Get the user name
-    #     user_name = interaction.user
-
-    #     # Get the message text
-    #     text = message.content
-
-    #     # If this is the first interaction from this user, onboard them
-    #     if user_name not in self.bot.bartleby_users.keys():
-    #         self.bot.bartleby_users[user_name] = user.User(user_name)
-
-    #     # Check to see that the user has set a gdrive folder id
-    #     # If they have, make the document
-    #     if self.bot.bartleby_users[user_name].gdrive_folder_id != None:
-            
-    #         # Make the document
-    #         self.bot.docx_instance.generate_from_text(self.bot.bartleby_users[user_name], text)
-            
-    #         # Post the reply and log the interaction
-    #         await interaction.response.send_message(f'```Document generated```')
-    #         self.logger.debug(f'Got make docx command from: {user_name}')
-
-    #     # If they have not set a gdrive folder id, ask them to set one
-    #     # before generating a document
-    #     elif self.bot.bartleby_users[user_name].gdrive_folder_id == None:
-
-    #         await interaction.response.send_message(f'```Please set a gdrive folder generating a document```')
-    #         self.logger.debug(f'Got make docx command without gdrive folder id from: {user_name}')
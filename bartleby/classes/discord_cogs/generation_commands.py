@@ -160,7 +160,8 @@ class Generation_commands(commands.Cog):
         # Check to make sure we have the model the user asked for 
         if model_type in conf.supported_models:
 
-            # Make the update
+            # Make the update, any reply in the works is from the old model
+            self.bot.bartleby_users[user_name].cancel_generation()
             self.bot.bartleby_users[user_name].model_type = model_type
 
             # Post the reply and log the interaction
@@ -1,5 +1,6 @@
 import discord
 import bartleby.configuration as conf
+import bartleby.functions.command_parsing_functions as command_funcs
 
 from discord import app_commands
 from discord.ext import commands
@@ -43,7 +44,7 @@ class System_commands(commands.Cog):
             self.bot.bartleby_users[user_name] = self.user.User(user_name)
 
         # Post the reply and log the interaction
-        await interaction.response.send_message(f'```LLM using last {conf.model_input_buffer_size} messages as input```')
+        await interaction.response.send_message(f'```LLM using up to {self.bot.bartleby_users[user_name].model_input_buffer_size} most recent messages after the system prompt, within the model\'s token budget```')
         self.logger.debug(f'Show input buffer size command from: {user_name}')
 
     @app_commands.command()
@@ -62,7 +63,7 @@ class System_commands(commands.Cog):
         self.bot.bartleby_users[user_name].model_input_buffer_size = buffer_size
 
         # Post the reply and log the interaction
-        await interaction.response.send_message(f'```Changed model input buffer to last {buffer_size} messages```')
+        await interaction.response.send_message(f'```Changed model input buffer to up to {buffer_size} most recent messages after the system prompt```')
         self.logger.debug(f'Update input buffer size to {buffer_size} command from: {user_name}')
 
     @app_commands.command()
@@ -76,13 +77,8 @@ class System_commands(commands.Cog):
         if user_name not in self.bot.bartleby_users.keys():
             self.bot.bartleby_users[user_name] = user.User(user_name)
 
-        # Select last n messages for input to the model
-        messages = []
-
-        for message in self.bot.bartleby_users[user_name].messages[-self.bot.bartleby_users[user_name].model_input_buffer_size:]:
-            messages.append(f"{message['role']}: {message['content']}")
-
-        result = '\n'.join(messages)
+        # Get the messages the model would take as input
+        result = command_funcs.input_messages(self.bot.llms, self.bot.bartleby_users[user_name])
 
         # Post the reply and log the interaction
         await interaction.response.send_message(f'```{result}```')
@@ -139,4 +135,26 @@ class System_commands(commands.Cog):
 
         # Post the reply and log the interaction
         await interaction.response.send_message(f'```Conversation reset```')
-        self.logger.debug(f'Restart chat command from: {user_name}')
\ No newline at end of file
+        self.logger.debug(f'Restart chat command from: {user_name}')
+
+    @app_commands.command()
+    async def cancel(self, interaction: discord.Interaction):
+        """Cancel the reply being generated"""
+
+        # Get the user name
+        user_name = interaction.user
+
+        # If this is the first interaction from this user, onboard them
+        if user_name not in self.bot.bartleby_users.keys():
+            self.bot.bartleby_users[user_name] = user.User(user_name)
+
+        # Make the update
+        if self.bot.bartleby_users[user_name].cancel_generation() == True:
+            result = 'Generation cancelled'
+
+        else:
+            result = 'Nothing to cancel'
+
+        # Post the reply and log the interaction
+        await interaction.response.send_message(f'```{result}```')
+        self.logger.debug(f'Cancel command from: {user_name}')
@@ -0,0 +1,213 @@
+import time
+import socket
+import threading
+import functools
+import httplib2
+import bartleby.configuration as conf
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+
+class Document_queue:
+    '''Class to run document jobs in the background. Documents are built
+    and uploaded to Google Drive by a pool of worker threads, so the
+    listeners only wait long enough to queue the job. When a job is done,
+    a message with the Drive file ID goes on the notification queue for
+    the listener to post.'''
+
+    def __init__(self, docx_instance, notification_queue, logger):
+
+        # Docx class instance to build and upload documents
+        self.docx_instance = docx_instance
+
+        # Queue to send finished jobs' messages to the listener, items
+        # are the user, the message and where to post it, or None to
+        # post it the usual way
+        self.notification_queue = notification_queue
+
+        # Retry settings for failed uploads
+        self.max_retries = conf.document_upload_retries
+        self.retry_delay = conf.document_retry_delay
+
+        # Worker threads for document jobs
+        self.executor = ThreadPoolExecutor(
+            max_workers = conf.document_workers,
+            thread_name_prefix = 'document_worker'
+        )
+
+        # Add logger
+        self.logger = logger
+
+    def submit(self, user, first_message_number, last_message_number, destination = None):
+        '''Queues a document made from a message, or range of messages, in the
+        user's chat history counting back from the most recent. Returns
+        acknowledgement to post in chat.'''
+
+        # Take the text now, by the time the job runs the user may
+        # have sent more messages and the numbers would be off
+        with user.lock:
+            try:
+                body = self.docx_instance.select_text(user, first_message_number, last_message_number)
+
+            except IndexError:
+                return 'Message number is out of range of the chat history'
+
+        return self.submit_text(user, body, destination)
+
+    def submit_text(self, user, body, destination = None):
+        '''Queues a document made from text. Destination is handed back with
+        the notification, e.g. a discord interaction to follow up on. Returns
+        acknowledgement to post in chat.'''
+
+        # Same for the title and folder, the user may change them while the job waits
+        document_title = user.document_title
+        gdrive_folder_id = user.gdrive_folder_id
+
+        self.executor.submit(self.run_job, user, document_title, gdrive_folder_id, body, destination)
+        self.logger.info(f'Queued document {document_title} for {user.user_name}')
+
+        return f'Making document {document_title}, will post the Google Drive file ID when it is uploaded'
+
+    def run_job(self, user, document_title, gdrive_folder_id, body, destination):
+        '''Builds and uploads a document, then sends the result to the
+        listener. Run on the worker threads.'''
+
+        job_start_time = time.time()
+
+        # Don't let a failed job take down the worker, tell the user instead
+        try:
+            file_id = self.make_document(document_title, gdrive_folder_id, body)
+
+        except Exception as error:
+            self.logger.error(f'Failed to make document {document_title} for {user.user_name}: {error}')
+            self.notification_queue.put((user, f'Failed to upload document {document_title}: {error}', destination))
+            return
+
+        self.logger.info(f'Made document {document_title} for {user.user_name} in {round(time.time() - job_start_time, 2)} seconds, file ID: {file_id}')
+        self.notification_queue.put((user, f'Uploaded document {document_title} to Google Drive, file ID: {file_id}', destination))
+
+    def submit_export(self, user, export_users, destination = None):
+        '''Queues one document for each reply in the chat histories of a list
+        of users, uploaded to the requesting user's folder. The documents are
+        built and uploaded in parallel on the document workers, and one message
+        listing all the file IDs is posted when the last is done. Returns
+        acknowledgement to post in chat.'''
+
+        # Take the text now, like for single documents. The titles get the
+        # time of the export so exporting again doesn't repeat them.
+        export_time = time.strftime('%Y%m%d-%H%M%S')
+        documents = []
+
+        for export_user in export_users:
+            with export_user.lock:
+                documents.extend(self.docx_instance.select_history(export_user, export_user is not user, export_time))
+
+        if len(documents) == 0:
+            return 'No replies in chat history to export'
+
+        gdrive_folder_id = user.gdrive_folder_id
+
+        # Results are collected here as the documents finish, in order
+        export = {
+            'results': [None] * len(documents),
+            'remaining': len(documents),
+            'failed': 0,
+            'start_time': time.time(),
+            'lock': threading.Lock()
+        }
+
+        # Each document is its own job, so they spread over all the workers.
+        # The last one to finish posts the results.
+        for index, (document_title, body) in enumerate(documents):
+
+            future = self.executor.submit(self.make_document, document_title, gdrive_folder_id, body)
+            future.add_done_callback(functools.partial(self.export_done, user, export, index, document_title, destination))
+
+        self.logger.info(f'Queued export of {len(documents)} documents for {user.user_name}')
+
+        return f'Exporting {len(documents)} documents, will post the Google Drive file IDs when they are uploaded'
+
+    def export_done(self, user, export, index, document_title, destination, future):
+        '''Records the result of one document in an export. Posts
+        the results once all the export's documents are done.'''
+
+        failed = 0
+
+        try:
+            result = f'{document_title}: {future.result()}'
+
+        except Exception as error:
+            self.logger.error(f'Failed to export document {document_title} for {user.user_name}: {error}')
+            result = f'{document_title}: failed, {error}'
+            failed = 1
+
+        with export['lock']:
+            export['results'][index] = result
+            export['remaining'] -= 1
+            export['failed'] += failed
+
+            if export['remaining'] > 0:
+                return
+
+        exported = len(export['results']) - export['failed']
+        self.logger.info(f"Exported {exported} of {len(export['results'])} documents for {user.user_name} in {round(time.time() - export['start_time'], 2)} seconds")
+
+        notification = '\n'.join([f"Exported {exported} of {len(export['results'])} documents to Google Drive, file IDs:"] + export['results'])
+        self.notification_queue.put((user, notification, destination))
+
+    def make_document(self, document_title, gdrive_folder_id, body):
+        '''Builds a document, uploads it and archives it if asked to.
+        Returns the Drive file ID. Run on the worker threads.'''
+
+        document = self.docx_instance.build_document(document_title, body)
+        file_id = self.upload(document, gdrive_folder_id, self.docx_instance.upload_filename(document_title))
+
+        # Keep a copy on disk if asked to, the document is already
+        # in Drive so failing to archive it is not worth failing the job
+        if conf.archive_documents == True:
+            try:
+                output_filename = self.docx_instance.archive(document, document_title)
+                self.logger.debug(f'Archived document {document_title} as {output_filename}')
+
+            except OSError as error:
+                self.logger.warning(f'Failed to archive document {document_title}: {error}')
+
+        return file_id
+
+    def upload(self, document, gdrive_folder_id, upload_filename):
+        '''Uploads a document, retrying transient failures with exponential
+        backoff. A resumable upload is retried from the chunk which failed,
+        not from the start. Returns the Drive file ID.'''
+
+        # The same request is kept for the whole upload, it
+        # remembers how much of a resumable upload is done
+        request = self.docx_instance.upload_request(document, gdrive_folder_id, upload_filename)
+
+        attempt = 0
+        file_id = None
+
+        while file_id is None:
+            try:
+                file_id = self.docx_instance.upload_step(request)
+
+            except Exception as error:
+
+                # Give up on errors which won't go away, or when out of retries
+                if is_transient(error) == False or attempt == self.max_retries:
+                    raise
+
+                delay = self.retry_delay * 2**attempt
+                attempt += 1
+
+                self.logger.warning(f'Upload of {upload_filename} failed, retry {attempt} of {self.max_retries} in {delay} seconds: {error}')
+                time.sleep(delay)
+
+        return file_id
+
+def is_transient(error):
+    '''Checks if an upload error is worth retrying: rate
+    limits, server errors and network trouble'''
+
+    if isinstance(error, HttpError):
+        return error.resp.status in (408, 429, 500, 502, 503, 504)
+
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout, httplib2.HttpLib2Error))
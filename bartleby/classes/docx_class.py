@@ -1,11 +1,18 @@
+import io
+import json
+import time
+import uuid
+import threading
 import bartleby.configuration as conf
 import google.auth
 
 from docx import Document
 from docx.shared import Pt
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from google.auth.credentials import AnonymousCredentials, with_scopes_if_required
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import MediaIoBaseUpload, build_http
 
 class Docx:
     '''Class to hold objects related to document output'''
@@ -14,176 +21,250 @@ class Docx:
 
         # Document generation stuff.
         self.document_path = conf.DOCUMENTS_PATH
-        self.template = Document(f'{self.document_path}/{conf.docx_template_file}')
 
-        # Google API service account credentials set via venv
-        self.service_account_credentials, _ = google.auth.default()
+        # Parse the template once and keep it as bytes with the paragraphs
+        # emptied out. Each job opens its own copy, so documents can be
+        # built in parallel on the document workers.
+        self.template_bytes = load_template(f'{self.document_path}/{conf.docx_template_file}')
 
-    def generate(self, user, first_message_number, last_message_number):
-        '''Recovers text from chat, formats as docx and
-        pushes to google drive'''
+        # Google API service account credentials set via venv. A fake
+        # Drive server for testing doesn't check them.
+        if conf.drive_anonymous_credentials == True:
+            self.service_account_credentials = AnonymousCredentials()
 
-        # Set gdrive folder id from user
-        self.gdrive_folder_id = user.gdrive_folder_id
+        else:
+            self.service_account_credentials, _ = google.auth.default()
+            self.service_account_credentials = with_scopes_if_required(
+                self.service_account_credentials,
+                ['https://www.googleapis.com/auth/drive']
+            )
+
+        # Drive API discovery document, read once from the copy
+        # bundled with the client library
+        self.discovery_document = get_static_doc('drive', 'v3')
+
+        # Point the client at a different server, e.g. a local fake Drive. The
+        # upload URLs come from the document's root URL, so that's set too.
+        # The paths are joined onto it, so it needs the trailing slash.
+        if conf.drive_api_endpoint is not None:
+            drive_api_endpoint = f"{conf.drive_api_endpoint.rstrip('/')}/"
 
-        # Load docx template
-        self.load_template()
+            discovery_document = json.loads(self.discovery_document)
+            discovery_document['rootUrl'] = drive_api_endpoint
+            discovery_document['baseUrl'] = f"{drive_api_endpoint}{discovery_document['servicePath']}"
+            self.discovery_document = json.dumps(discovery_document)
 
-        # Add heading 
-        result = self.template.add_paragraph(user.document_title, style = 'Heading 1')
+        # Each document worker thread keeps its own Drive API client
+        self.thread_local = threading.local()
 
-        # Decide how to select message from the chat history
+    def select_text(self, user, first_message_number, last_message_number):
+        '''Recovers text from chat. Takes the number of a message counting
+        back from the most recent, or the first and last numbers of a range
+        of messages. Returns the text, messages in a range are joined
+        by newlines so each starts a new paragraph.'''
 
         # If there is no second message range parameter, just get
         # the message specified by the first message range parameter
         if last_message_number == None:
-            body = user.messages[-first_message_number]['content']
+            return user.messages[-first_message_number]['content']
 
-            # Split on newline so we can format paragraphs correctly
-            paragraphs = body.split('\n')
+        # Empty holder for message contents
+        contents = []
 
-        else:
-            # Empty holder for paragraphs
-            paragraphs = []
-            body = []
+        # Loop on messages in range
+        while last_message_number >= first_message_number:
 
-            # Loop on messages in range
-            while last_message_number >= first_message_number:
-                #for message in user.messages[-last_message_number:-first_message_number]:
-                
-                # Get message content
-                content = user.messages[-last_message_number]['content']
-                last_message_number -= 1
+            contents.append(user.messages[-last_message_number]['content'])
+            last_message_number -= 1
 
-                # Spit on any newlines and add to paragraphs list 
-                paragraphs.extend(content.split('\n'))
-                body.append(content)
+        return '\n'.join(contents)
 
-            body = ' '.join(body)
+    def select_history(self, user, include_user_name, export_time):
+        '''Recovers the replies in a user's chat history for export, one
+        document each. Titles are the user's document title and the time of
+        the export, numbered in order, starting with their user name if
+        asked. Returns list of title and text pairs.'''
 
-        paragraph_count = 0
+        documents = []
 
-        # Loop on paragraphs and add them to doc
-        for paragraph in paragraphs:
+        for message in user.messages:
+            if message['role'] == 'assistant':
 
-            # Make sure this 'paragraph' has content, i.e. it wasn't
-            # the result of splitting a multiple newline
-            if len(paragraph) > 0:
+                document_title = f'{user.document_title} {export_time} {len(documents) + 1}'
 
-                # Add the paragraph to the document
-                paragraph_count += 1
-                result = self.template.add_paragraph(paragraph)
+                if include_user_name == True:
+                    document_title = f'{user.user_name} {document_title}'
 
-                # Deal with spacing between paragraphs. If the body contains
-                # multiple paragraphs and this is not the last one, add some
-                # space after it.
-                if (len(paragraphs) > 1) and (paragraph_count < len(body)):
-                    result.paragraph_format.space_after = Pt(6)
+                documents.append((document_title, message['content']))
 
-        # Format output file name for docx file
-        output_filename = f'{user.document_title.replace(" ", "_")}.docx'
+        return documents
 
-        # Save the docx
-        self.template.save(f'{self.document_path}/{output_filename}')
+    def upload_filename(self, document_title):
+        '''Returns the file name for a document in Google Drive'''
 
-        # Upload the docx to gdrive
-        result = self.upload(output_filename)
+        return f'{document_title.replace(" ", "_")}.docx'
 
-    def generate_from_text(self, user, body):
-        '''Takes user and text, generates and upload docx to gdrive'''
+    def build_document(self, document_title, body):
+        '''Takes document title and text, formats as docx in memory.
+        Returns the document as bytes.'''
 
-        # Set gdrive folder id from user
-        self.gdrive_folder_id = user.gdrive_folder_id
+        return make_document_bytes(self.template_bytes, document_title, body)
 
-        # Load docx template
-        self.load_template()
+    def archive(self, document, document_title):
+        '''Takes document as bytes and its title, saves a copy to the documents
+        directory. Returns the output file name.'''
 
-        # Add heading 
-        result = self.template.add_paragraph(user.document_title, style = 'Heading 1')
+        # Format output file name for docx file. Documents with the same title
+        # are made all the time, so each gets its own file
+        output_filename = f'{document_title.replace(" ", "_")}_{time.strftime("%Y%m%d-%H%M%S")}_{uuid.uuid4().hex[:8]}.docx'
 
-        # Split on newlines to make paragraphs
-        paragraphs = body.split('\n')
+        with open(f'{self.document_path}/{output_filename}', 'wb') as output_file:
+            output_file.write(document)
 
-        paragraph_count = 0
+        return output_filename
 
-        # Loop on paragraphs and add them to doc
-        for paragraph in paragraphs:
+    def drive_service(self):
+        '''Returns the calling thread's Drive API client, building it the first
+        time. httplib2 connections aren't thread safe, so each thread has its
+        own, kept open and reused for all of that thread's uploads.'''
 
-            # Make sure this 'paragraph' has content, i.e. it wasn't
-            # the result of splitting a multiple newline
-            if len(paragraph) > 0:
+        service = getattr(self.thread_local, 'service', None)
 
-                # Add the paragraph to the document
-                paragraph_count += 1
-                result = self.template.add_paragraph(paragraph)
+        if service is None:
 
-                # Deal with spacing between paragraphs. If the body contains
-                # multiple paragraphs and this is not the last one, add some
-                # space after it.
-                if (len(paragraphs) > 1) and (paragraph_count < len(body)):
-                    result.paragraph_format.space_after = Pt(6)
+            # The client library's HTTP object leaves 308s alone
+            # so resumable uploads can read them
+            http = build_http()
+            http.timeout = conf.drive_http_timeout
 
-        # Format output file name for docx file
-        output_filename = f'{user.document_title.replace(" ", "_")}.docx'
+            http = AuthorizedHttp(self.service_account_credentials, http = http)
 
-        # Save the docx
-        self.template.save(f'{self.document_path}/{output_filename}')
+            service = build_from_document(
+                self.discovery_document,
+                http = http
+            )
 
-        # Upload the docx to gdrive
-        result = self.upload(output_filename)
+            self.thread_local.service = service
 
-    def load_template(self):
-        '''Loads and returns empty docx document
-        with some pre-defined styles'''
+        return service
 
-        # Empty out template
-        lines = self.template.paragraphs
+    def upload_request(self, document, gdrive_folder_id, upload_filename):
+        '''Takes document as bytes, Google Drive folder ID and the name to give
+        the file in Drive, makes the request to upload the document to the
+        folder straight from memory. Returns the request, for upload_step
+        to send.'''
 
-        for line in lines:
-            p = line._element
-            p.getparent().remove(p)
-            p._p = p._element = None
+        # Get this thread's drive api client
+        service = self.drive_service()
 
-    def upload(self, filename):
-        '''Takes file name as string. uploads to google drive
-        Returns : Id's of the file uploaded'''
+        # Set file metadata
+        file_metadata = {
+            'name': upload_filename,
+            'parents': [f'{gdrive_folder_id}']
+        }
 
-        try:
-            # create drive api client
-            service = build(
-                'drive', 
-                'v3', 
-                credentials = self.service_account_credentials
-            )
+        # Create media
+        file_type = 'text/plain'
 
-            # Set file metadata
-            file_metadata = {
-                'name': filename,
-                'parents': [f'{self.gdrive_folder_id}']
-            }
+        if 'docx' in upload_filename:
+            file_type = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
 
-            # Create media
-            file_type = 'text/plain'
+        # Large documents go up in chunks with a resumable upload, so a
+        # dropped connection only has to resend the current chunk
+        resumable = len(document) > conf.drive_resumable_threshold
 
-            if 'docx' in filename:
-                file_type = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+        media = MediaIoBaseUpload(
+            io.BytesIO(document),
+            mimetype = file_type,
+            chunksize = conf.drive_upload_chunk_size,
+            resumable = resumable
+        )
+        
+        # Make the upload request
+        request = service.files().create(
+            body = file_metadata, 
+            media_body = media,
+            fields = 'id'
+        )
 
-            media = MediaFileUpload(
-                f'{conf.DOCUMENTS_PATH}/{filename}',
-                mimetype = file_type
-            )
-            
-            # Do the upload
-            file = service.files().create(
-                body = file_metadata, 
-                media_body = media,
-                fields = 'id'
-            ).execute()
-
-        # Catch http errors
-        except HttpError as error:
-            print(f'An error occurred while uploading file: {error}')
-            file = None
+        return request
+
+    def upload_step(self, request):
+        '''Sends an upload request, or the next chunk of a resumable one. Returns
+        the Id of the uploaded file once the upload is done, otherwise None.
+        Errors are raised for the caller to retry or report, a resumable
+        request picks up where it left off when sent again.'''
+
+        if request.resumable is None:
+            file = request.execute()
+
+        else:
+            _, file = request.next_chunk()
+
+            # More chunks to go
+            if file is None:
+                return None
 
         # Done
-        return file.get('id')
\ No newline at end of file
+        return file.get('id')
+
+def load_template(template_file):
+    '''Loads docx template with some pre-defined styles, empties
+    out its paragraphs and returns it as bytes'''
+
+    template = Document(template_file)
+
+    # Empty out template
+    for line in template.paragraphs:
+        p = line._element
+        p.getparent().remove(p)
+
+    return document_bytes(template)
+
+def document_bytes(document):
+    '''Returns docx document serialized to bytes'''
+
+    buffer = io.BytesIO()
+    document.save(buffer)
+
+    return buffer.getvalue()
+
+def make_document(template_bytes, document_title, body):
+    '''Takes template as bytes, document title and text. Opens a fresh copy
+    of the template and adds the title and text. Returns the document. Shares
+    no state, so it can run on many threads or processes at once.'''
+
+    document = Document(io.BytesIO(template_bytes))
+
+    # Add heading 
+    result = document.add_paragraph(document_title, style = 'Heading 1')
+
+    # Split on newlines to make paragraphs
+    paragraphs = body.split('\n')
+
+    paragraph_count = 0
+
+    # Loop on paragraphs and add them to doc
+    for paragraph in paragraphs:
+
+        # Make sure this 'paragraph' has content, i.e. it wasn't
+        # the result of splitting a multiple newline
+        if len(paragraph) > 0:
+
+            # Add the paragraph to the document
+            paragraph_count += 1
+            result = document.add_paragraph(paragraph)
+
+            # Deal with spacing between paragraphs. If the body contains
+            # multiple paragraphs and this is not the last one, add some
+            # space after it.
+            if (len(paragraphs) > 1) and (paragraph_count < len(body)):
+                result.paragraph_format.space_after = Pt(6)
+
+    return document
+
+def make_document_bytes(template_bytes, document_title, body):
+    '''Makes a document and returns it serialized to bytes, for
+    building documents on a process pool'''
+
+    return document_bytes(make_document(template_bytes, document_title, body))
@@ -0,0 +1,230 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import bartleby.configuration as conf
+
+class Kv_cache:
+    '''Class to hold past key values from earlier turns of each user's
+    conversation, so that the part of the prompt the model has already
+    seen does not need to be prefilled again'''
+
+    def __init__(self, logger):
+
+        # Memory budget for all users' cached key values, in bytes
+        self.memory_budget = conf.kv_cache_memory_budget * 10**9
+
+        # Device to hold cached key values on between turns. None keeps
+        # them on the model's device, 'cpu' offloads them to system memory
+        self.storage_device = conf.kv_cache_device
+
+        # Cache entries keyed by user name, least recently used first.
+        # Each entry holds the conversation ID the cache was built for,
+        # the token IDs covered by the cache, the key values and their size
+        self.entries = OrderedDict()
+        self.memory_used = 0
+
+        # Shared cache of system prompt key values, keyed by model type and
+        # hash of the prompt text, least recently used first. Most users share
+        # the default prompt, users who set their own get their own entry.
+        # Each entry holds the prompt's token IDs and key values.
+        self.prompt_entries = OrderedDict()
+        self.max_prompt_entries = conf.prompt_cache_max_entries
+
+        # Generator threads and listeners both touch the cache
+        self.lock = threading.Lock()
+
+        # Add logger
+        self.logger = logger
+
+    def get(self, user, input_ids, device):
+        '''Takes user and their tokenized prompt as list. Returns past key values
+        for the longest cached prefix of the prompt and the prefix length.
+        Returns None and zero if nothing usable is cached.'''
+
+        with self.lock:
+
+            if user.user_name not in self.entries:
+                return None, 0
+
+            conversation_id, cached_ids, past_key_values, num_bytes = self.entries[user.user_name]
+
+            # If the user has restarted their conversation since the
+            # cache was built, it's no good
+            if conversation_id != user.conversation_id:
+                self.remove(user.user_name)
+                self.logger.debug(f'Dropped stale KV cache for {user.user_name}')
+                return None, 0
+
+            # Mark as most recently used
+            self.entries.move_to_end(user.user_name)
+
+        # Find how much of the new prompt matches the cached tokens. If the
+        # input window slid forward the match will be short or empty. At least
+        # one prompt token has to be left for the model to process.
+        prefix_length = common_prefix_length(cached_ids, input_ids)
+        prefix_length = min(prefix_length, len(input_ids) - 1)
+
+        if prefix_length == 0:
+            return None, 0
+
+        # Trim the cached key values to the matching prefix and move to the model
+        past_key_values = crop_past_key_values(past_key_values, prefix_length, device)
+
+        return past_key_values, prefix_length
+
+    def put(self, user, token_ids, past_key_values):
+        '''Takes user, list of token IDs covered by past key values and the past key
+        values from generate. Stores the cache, evicting least recently used
+        users' caches as needed to stay under the memory budget.'''
+
+        # Newer versions of transformers may hand back a cache object
+        if hasattr(past_key_values, 'to_legacy_cache'):
+            past_key_values = past_key_values.to_legacy_cache()
+
+        # Move to storage device if we are offloading
+        if self.storage_device is not None:
+            past_key_values = crop_past_key_values(past_key_values, len(token_ids), self.storage_device)
+
+        num_bytes = past_key_values_size(past_key_values)
+
+        with self.lock:
+
+            # Replace any older entry for this user
+            self.remove(user.user_name)
+
+            # Don't bother if it could never fit
+            if num_bytes > self.memory_budget:
+                self.logger.debug(f'KV cache for {user.user_name} is larger than budget, not cached')
+                return
+
+            # Evict least recently used until there is room
+            while self.memory_used + num_bytes > self.memory_budget:
+                evicted_user_name = next(iter(self.entries))
+                self.remove(evicted_user_name)
+                self.logger.debug(f'Evicted KV cache for {evicted_user_name}')
+
+            self.entries[user.user_name] = (user.conversation_id, token_ids, past_key_values, num_bytes)
+            self.memory_used += num_bytes
+
+        self.logger.debug(f'Cached {len(token_ids)} tokens for {user.user_name}, KV cache using {round(self.memory_used / 10**9, 2)} GB')
+
+    def prompt_key(self, model_type, prompt):
+        '''Returns key for the prompt cache'''
+
+        return (model_type, hashlib.sha256(prompt.encode('utf-8')).hexdigest())
+
+    def has_prompt(self, model_type, prompt):
+        '''Checks if a system prompt is in the prompt cache'''
+
+        with self.lock:
+            return self.prompt_key(model_type, prompt) in self.prompt_entries
+
+    def get_prompt(self, model_type, prompt, input_ids, device):
+        '''Takes model type, system prompt text and tokenized model input as list.
+        Returns the cached system prompt key values covering the start of the
+        input and the prefix length. Returns None and zero if the prompt is
+        not cached.'''
+
+        key = self.prompt_key(model_type, prompt)
+
+        with self.lock:
+
+            if key not in self.prompt_entries:
+                return None, 0
+
+            # Mark as most recently used
+            self.prompt_entries.move_to_end(key)
+            prompt_ids, past_key_values = self.prompt_entries[key]
+
+        # The prompt was tokenized on its own, so the last token or two may
+        # not match the full input. Use the part that does.
+        prefix_length = common_prefix_length(prompt_ids, input_ids)
+        prefix_length = min(prefix_length, len(input_ids) - 1)
+
+        if prefix_length == 0:
+            return None, 0
+
+        past_key_values = crop_past_key_values(past_key_values, prefix_length, device)
+
+        return past_key_values, prefix_length
+
+    def put_prompt(self, model_type, prompt, token_ids, past_key_values):
+        '''Takes model type, system prompt text, its token IDs and key values.
+        Stores them in the prompt cache, evicting the least recently used
+        prompt if the cache is full.'''
+
+        if hasattr(past_key_values, 'to_legacy_cache'):
+            past_key_values = past_key_values.to_legacy_cache()
+
+        if self.storage_device is not None:
+            past_key_values = crop_past_key_values(past_key_values, len(token_ids), self.storage_device)
+
+        key = self.prompt_key(model_type, prompt)
+
+        with self.lock:
+
+            self.prompt_entries[key] = (token_ids, past_key_values)
+            self.prompt_entries.move_to_end(key)
+
+            while len(self.prompt_entries) > self.max_prompt_entries:
+                self.prompt_entries.popitem(last=False)
+
+        self.logger.debug(f'Cached {len(token_ids)} token system prompt for {model_type}, {len(self.prompt_entries)} prompts cached')
+
+    def clear(self):
+        '''Drops all users' and prompts' caches'''
+
+        with self.lock:
+            self.entries.clear()
+            self.prompt_entries.clear()
+            self.memory_used = 0
+
+    def invalidate(self, user_name):
+        '''Drops a user's cache'''
+
+        with self.lock:
+            self.remove(user_name)
+
+    def remove(self, user_name):
+        '''Drops a user's cache, caller must hold the lock'''
+
+        if user_name in self.entries:
+            num_bytes = self.entries.pop(user_name)[3]
+            self.memory_used -= num_bytes
+
+def common_prefix_length(first_ids, second_ids):
+    '''Returns number of leading tokens two lists of token IDs share'''
+
+    prefix_length = 0
+
+    for first_id, second_id in zip(first_ids, second_ids):
+        if first_id != second_id:
+            break
+
+        prefix_length += 1
+
+    return prefix_length
+
+def crop_past_key_values(past_key_values, length, device):
+    '''Trims each layer's keys and values to the first length positions
+    and moves them to device'''
+
+    cropped_past_key_values = []
+
+    for layer in past_key_values:
+        cropped_past_key_values.append(tuple(
+            tensor[..., :length, :].to(device) for tensor in layer
+        ))
+
+    return tuple(cropped_past_key_values)
+
+def past_key_values_size(past_key_values):
+    '''Returns memory used by past key values in bytes'''
+
+    num_bytes = 0
+
+    for layer in past_key_values:
+        for tensor in layer:
+            num_bytes += tensor.element_size() * tensor.nelement()
+
+    return num_bytes
@@ -1,89 +1,418 @@
 import gc
 import time
+import threading
+import psutil
 import torch
 import bartleby.configuration as conf
 import bartleby.functions.model_prompting_functions as prompt_funcs
-from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig, BitsAndBytesConfig
+import bartleby.classes.streamer_class as streamer_class
+import bartleby.classes.kv_cache_class as kv_cache_class
+import bartleby.classes.stopping_criteria_class as stopping_criteria_class
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, GenerationConfig, BitsAndBytesConfig, StoppingCriteriaList
 
 class Llm:
     '''Class to hold object related to the LLM'''
 
-    def __init__(self, logger):
+    def __init__(self, logger, device_map=None):
 
-        # Set device map
-        self.device_map = conf.device_map
+        # Set device map, the model pool picks a device for
+        # each model, otherwise use the default
+        if device_map is None:
+            device_map = conf.device_map
 
-        # Set quantization
-        self.quantization = conf.model_quantization
+        self.device_map = device_map
+
+        # Set quantization, bitsandbytes needs a GPU so
+        # models on the CPU have their own setting
+        if self.on_cpu() == True:
+            self.quantization = conf.CPU_quantization
+
+        else:
+            self.quantization = conf.model_quantization
 
         # Add logger
         self.logger = logger
 
+        # Cache of users' past key values from earlier turns
+        self.kv_cache = kv_cache_class.Kv_cache(logger)
+
+        # Set once the model weights are loaded
+        self.ready = threading.Event()
+
+        # Residency bookkeeping for the model pool: GPU memory used by the
+        # weights and the peak extra memory used during generation in bytes,
+        # when the model was last used, how many generations are running on
+        # it and if it has been evicted to free GPU memory
+        self.weights_memory = 0
+        self.generation_memory = 0
+
+        # On the CPU, peak memory is sampled by a background thread while
+        # generating, stopped by setting the event
+        self.sampled_peak_memory = 0
+        self.memory_sampler = None
+        self.stop_memory_sampler = None
+        self.last_used = time.time()
+        self.active_generations = 0
+        self.evicted = False
+        self.offloaded = False
+
+        # Time spent generating since utilisation was last logged
+        # and when the current generation started
+        self.busy_time = 0
+        self.busy_since = None
+
+        # Small draft model for assisted decoding, if used
+        self.draft_model = None
+
     def initialize_model(self, model_type):
         '''Fire up a model'''
 
+        self.initialize_generation_configuration(model_type)
+        self.load_model()
+
+    def initialize_generation_configuration(self, model_type):
+        '''Sets model type and reads the model's default generation
+        configuration. This is fast, it does not load the model weights.'''
+
         # Set model type
         self.model_type = model_type
 
+        # Read the default generation config from the model's configuration
+        model_configuration = AutoConfig.from_pretrained(self.model_type)
+
+        self.default_generation_configuration = GenerationConfig.from_model_config(
+            model_configuration
+        )
+
+        # Replace some stock values with new defaults from configuration file
+        self.default_generation_configuration.max_new_tokens = conf.max_new_tokens
+        #self.default_generation_configuration.length_penalty = conf.length_penalty
+        self.default_generation_configuration.torch_dtype = torch.bfloat16
+
+    def load_model(self):
+        '''Loads the tokenizer and model weights. Slow, so this is run
+        in the background by the model pool.'''
+
+        # Process memory before loading, see below
+        memory_before = psutil.Process().memory_info().rss
+
         # Fire up the model and tokenizer
         if self.model_type in conf.supported_models:
 
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_type)
+            self.load_tokenizer()
 
-            if self.quantization == 'four bit':
-                quantization_config = BitsAndBytesConfig(
-                    load_in_4bit=True, 
-                    bnb_4bit_compute_dtype=torch.float16
-                )
+            if self.on_cpu() == True:
+                self.model = self.load_cpu_model(self.model_type)
 
             else:
-                quantization_config = None
+                if self.quantization == 'four bit':
+                    quantization_config = BitsAndBytesConfig(
+                        load_in_4bit=True, 
+                        bnb_4bit_compute_dtype=torch.float16
+                    )
+
+                else:
+                    quantization_config = None
+
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.model_type,
+                    device_map = self.device_map,
+                    quantization_config=quantization_config
+                )
+
+        # Load the draft model for assisted decoding, if we have one
+        self.load_draft_model()
+
+        # Record memory used by the weights
+        self.weights_memory = self.model.get_memory_footprint()
+
+        if self.draft_model is not None:
+            self.weights_memory += self.draft_model.get_memory_footprint()
 
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_type,
+        # The footprint misses the packed weights of int8 quantized layers,
+        # which aren't parameters, so on the CPU use how much the process
+        # grew while loading. This errs high if memory freed while loading
+        # isn't handed back, or another model loads at the same time.
+        if self.on_cpu() == True:
+            self.weights_memory = max(self.weights_memory, psutil.Process().memory_info().rss - memory_before)
+
+        # Prefill the default system prompt shared by new users
+        if conf.kv_cache == True:
+            self.cache_system_prompt(conf.initial_prompt)
+
+        # Ready for generation
+        self.evicted = False
+        self.ready.set()
+
+    def load_tokenizer(self):
+        '''Loads the tokenizer and tokenizes the generation prompt'''
+
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_type)
+
+        # Pad on the left so that all prompts in a batch end
+        # where generation starts
+        self.tokenizer.padding_side = 'left'
+
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # Token IDs which end every prompt
+        self.generation_prompt_ids = prompt_funcs.tokenize_generation_prompt(self.model_type, self.tokenizer)
+
+    def load_draft_model(self):
+        '''Loads the small draft model used for assisted decoding, if assisted
+        decoding is on and the configuration file gives one for this model. The
+        draft model has to share the main model's tokenizer.'''
+
+        draft_model_type = conf.draft_models.get(self.model_type)
+
+        if conf.assisted_decoding == False or draft_model_type is None:
+            self.draft_model = None
+            return
+
+        if self.on_cpu() == True:
+            self.draft_model = self.load_cpu_model(draft_model_type)
+
+        else:
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_type,
+                device_map = self.device_map
+            )
+
+        # Number of tokens the draft model proposes per step to start with,
+        # generate adjusts it as it goes depending on how many are accepted
+        self.draft_model.generation_config.num_assistant_tokens = conf.num_assistant_tokens
+
+        self.logger.info(f'Loaded {draft_model_type} as draft model for {self.model_type}')
+
+    def load_cpu_model(self, model_type):
+        '''Loads a model for generation on the CPU. Quantizes the linear
+        layers' weights to int8, or loads the weights as bf16, depending
+        on the CPU quantization setting.'''
+
+        if self.quantization == 'bf16':
+            model = AutoModelForCausalLM.from_pretrained(
+                model_type,
                 device_map = self.device_map,
-                quantization_config=quantization_config
+                torch_dtype = torch.bfloat16
             )
 
-        # Read the default generation config from the model
-        self.default_generation_configuration = GenerationConfig.from_model_config(
-            self.model.config
-        )
+        else:
+            model = AutoModelForCausalLM.from_pretrained(
+                model_type,
+                device_map = self.device_map
+            )
 
-        # Replace some stock values with new defaults from configuration file
-        self.default_generation_configuration.max_new_tokens = conf.max_new_tokens
-        #self.default_generation_configuration.length_penalty = conf.length_penalty
-        self.default_generation_configuration.torch_dtype = torch.bfloat16
+        # Dynamic quantization stores the weights as int8 and quantizes
+        # activations on the fly, so it needs no calibration data
+        if self.quantization == 'int8':
+            model = torch.quantization.quantize_dynamic(
+                model,
+                {torch.nn.Linear},
+                dtype = torch.qint8
+            )
+
+        model.eval()
+
+        return model
+
+    def on_cpu(self):
+        '''Checks if the model runs on the CPU rather than a GPU'''
+
+        return str(self.device_map).startswith('cpu')
+
+    def reset_memory_stats(self):
+        '''Resets peak memory stats for the model's device and returns
+        memory in use in bytes. On the CPU this is the process's
+        resident memory, and a thread starts sampling it for the peak.'''
+
+        if self.on_cpu() == True:
+
+            # Stop the last sampler, in case generation failed before it was read
+            self.stop_sampling_memory()
+
+            memory = psutil.Process().memory_info().rss
+            self.sampled_peak_memory = memory
+
+            self.stop_memory_sampler = threading.Event()
+            self.memory_sampler = threading.Thread(target=self.sample_memory, args=[self.stop_memory_sampler], daemon=True)
+            self.memory_sampler.start()
+
+            return memory
+
+        torch.cuda.reset_peak_memory_stats(self.device_map)
+
+        return torch.cuda.memory_allocated(self.device_map)
+
+    def peak_memory(self):
+        '''Returns peak memory use on the model's device in bytes since the stats
+        were last reset. On the CPU this is the highest resident memory sampled.'''
+
+        if self.on_cpu() == True:
+            self.stop_sampling_memory()
+
+            return max(self.sampled_peak_memory, psutil.Process().memory_info().rss)
+
+        return torch.cuda.max_memory_allocated(self.device_map)
+
+    def sample_memory(self, stop):
+        '''Keeps the highest resident memory of the process until stopped,
+        run on the memory sampler thread'''
+
+        process = psutil.Process()
+
+        while stop.wait(conf.CPU_memory_sample_interval) == False:
+            self.sampled_peak_memory = max(self.sampled_peak_memory, process.memory_info().rss)
+
+    def stop_sampling_memory(self):
+        '''Stops the memory sampler thread, if it's running'''
+
+        if self.memory_sampler is not None:
+            self.stop_memory_sampler.set()
+            self.memory_sampler.join()
+            self.memory_sampler = None
+
+    def empty_cache(self):
+        '''Collects garbage and hands cached GPU memory back'''
+
+        gc.collect()
+
+        if torch.cuda.is_available() == True:
+            torch.cuda.empty_cache()
+
+    def memory_footprint(self):
+        '''Returns estimated GPU memory needed by the model in bytes: the
+        weights, peak generation overhead and any cached key values'''
+
+        footprint = self.weights_memory + self.generation_memory
+
+        if conf.kv_cache_device is None:
+            footprint += self.kv_cache.memory_used
+
+        return footprint
+
+    def evict(self, target):
+        '''Frees the model's GPU memory. Target 'cpu' moves the weights to system
+        memory, 'disk' drops them so they are reloaded from the HuggingFace cache.
+        Quantized weights can't be moved, so they always go to disk, as do
+        models which are already on the CPU.'''
+
+        # Not available for generation until restored
+        self.ready.clear()
+
+        # Cached key values live on the model's device, drop them too
+        self.kv_cache.clear()
+
+        if target == 'cpu' and self.quantization != 'four bit' and self.on_cpu() == False:
+            self.model.to('cpu')
+
+            if self.draft_model is not None:
+                self.draft_model.to('cpu')
+
+            self.offloaded = True
+
+        else:
+            del self.model
+            self.draft_model = None
+            self.offloaded = False
+
+        # Clean up memory
+        self.empty_cache()
+
+        self.evicted = True
+
+    def restore(self):
+        '''Brings an evicted model back for generation'''
+
+        # Move offloaded weights back
+        if self.offloaded == True:
+            self.model.to(self.device_map)
+
+            if self.draft_model is not None:
+                self.draft_model.to(self.device_map)
+
+            self.offloaded = False
+
+            if conf.kv_cache == True:
+                self.cache_system_prompt(conf.initial_prompt)
+
+            self.evicted = False
+            self.ready.set()
+
+        # Or reload them from disk
+        else:
+            self.load_model()
 
     def restart_model(self, model_type):
 
+        # Not available while restarting
+        self.ready.clear()
+
         # Get rid of model and tokenizer
         del self.model
         del self.tokenizer
 
         # Clean up memory
-        gc.collect()
-        torch.cuda.empty_cache()
+        self.empty_cache()
 
         self.initialize_model(model_type)
 
+    def cache_system_prompt(self, prompt):
+        '''Prefills a system prompt and keeps its key values in the
+        shared prompt cache'''
+
+        # Tokenize the prompt the way it starts a conversation
+        token_ids = prompt_funcs.tokenize_system_prompt(self.model_type, prompt, self.tokenizer)
+        input_ids = torch.tensor([token_ids], device=self.model.device)
+
+        # Run the prompt through the model to get its key values
+        with torch.no_grad():
+            output = self.model(input_ids=input_ids, use_cache=True)
+
+        self.kv_cache.put_prompt(self.model_type, prompt, token_ids, output.past_key_values)
+
     def prompt_model(self, user):
         '''Prompts model, using and updating the user's chat buffer.'''
 
-        # Give torch the requested CPU resources
-        torch.set_num_threads(conf.CPU_threads)
-        self.logger.info(f'Assigned {conf.CPU_threads} CPU threads')
+        return self.prompt_model_batch([user])
 
-        # If we are early in the conversation, the chat history may be shorter
-        # than the model input buffer size, in that case, use the length
-        # of the chat history as the input buffer size
-        if len(user.messages) < user.model_input_buffer_size:
-            model_input_buffer_size = len(user.messages)
+    def message_token_ids(self, message):
+        '''Returns a message's token IDs for this model, caller must hold the
+        user's lock. Messages are tokenized the first time they are used
+        with a model and the IDs are kept on the message.'''
 
-        else:
-            # If we have enough past messages, use the full buffer size from the
-            # Users config
-            model_input_buffer_size = user.model_input_buffer_size
+        token_ids = message.setdefault('token_ids', {})
+
+        if self.model_type not in token_ids:
+            token_ids[self.model_type] = prompt_funcs.tokenize_message(self.model_type, message, self.tokenizer)
+
+        return token_ids[self.model_type]
+
+    def count_tokens(self, message):
+        '''Returns the number of tokens a message adds to the model input,
+        caller must hold the user's lock'''
+
+        return len(self.message_token_ids(message))
+
+    def build_input_ids(self, input_messages):
+        '''Returns the model input for a list of messages as list of token IDs:
+        the messages' cached token IDs followed by the generation prompt.
+        Caller must hold the user's lock.'''
+
+        input_ids = []
+
+        for message in input_messages:
+            input_ids.extend(self.message_token_ids(message))
+
+        input_ids.extend(self.generation_prompt_ids)
+
+        return input_ids
+
+    def select_input_messages(self, user):
+        '''Selects messages from the user's chat history for input to the
+        model. Always keeps the system prompt, then takes the most recent
+        messages which fit in the model's token budget, up to the user's
+        model input buffer size.'''
 
         # Log user's chat history for debug
         i = 0
@@ -92,10 +421,46 @@ class Llm:
             self.logger.debug(f'{user.user_name}\'s chat buffer message {i}: {message}')
             i += 1
 
-        self.logger.debug(f'Model input size: {model_input_buffer_size} most recent messages')
+        token_budget = conf.context_token_budgets.get(self.model_type, conf.default_context_token_budget)
+
+        # Keep the system prompt, if there is one
+        if user.messages[0]['role'] == 'system':
+            system_messages = [user.messages[0]]
+            chat_messages = user.messages[1:]
+
+        else:
+            system_messages = []
+            chat_messages = user.messages
+
+        num_tokens = sum(self.count_tokens(message) for message in system_messages)
+
+        # Add messages newest first until we run out of budget or hit the
+        # buffer size. The newest message always goes in, it's what we are
+        # replying to.
+        selected_messages = []
+
+        for message in reversed(chat_messages):
+
+            if len(selected_messages) >= user.model_input_buffer_size:
+                break
+
+            message_tokens = self.count_tokens(message)
+
+            if len(selected_messages) > 0 and num_tokens + message_tokens > token_budget:
+                break
+
+            selected_messages.insert(0, message)
+            num_tokens += message_tokens
+
+        # Start the conversation on a user turn, chat templates
+        # expect user and assistant turns to alternate from there
+        while len(selected_messages) > 1 and selected_messages[0]['role'] == 'assistant':
+            num_tokens -= self.count_tokens(selected_messages.pop(0))
+
+        # Copy the messages so that later changes don't affect this generation
+        input_messages = system_messages + selected_messages
 
-        # Select last n messages from chat history for input to the model
-        input_messages = user.messages[-model_input_buffer_size:]
+        self.logger.info(f'Model input for {user.user_name}: last {len(selected_messages)} of {len(chat_messages)} messages, about {num_tokens} of {token_budget} budgeted tokens')
 
         i = 0
 
@@ -104,64 +469,223 @@ class Llm:
             self.logger.debug(f'Model input {i}: {message}')
             i += 1
 
-        self.logger.info('Prompting model')
+        return input_messages
+
+    def prompt_model_batch(self, users, stream_queue=None):
+        '''Prompts model once for a batch of users which share a model
+        type and generation configuration. Updates each user's chat buffer.
+        If a stream queue is given, partial replies are sent on it during
+        generation. Returns the users for the listener: those with a reply
+        to post, and those whose streamed reply was cancelled.'''
+
+        # Collect the model input messages for each user in the batch. Snapshot
+        # each user's chat history as the generation starts: the conversation
+        # it belongs to and where the reply goes, since the user may send more
+        # messages while we are generating. Also collect their cancellation events.
+        batch_input_messages = []
+        batch_input_ids = []
+        snapshots = []
+        cancellations = []
+
+        for user in users:
+            with user.lock:
+                batch_input_messages.append(self.select_input_messages(user))
+                batch_input_ids.append(self.build_input_ids(batch_input_messages[-1]))
+                snapshots.append((user.conversation_id, len(user.messages)))
+                cancellations.append(user.running_cancellation)
+
+        # Users in a batch share a generation configuration, so take the first
+        generation_configuration = users[0].generation_configurations[self.model_type]
+        self.logger.debug(generation_configuration)
+
+        # Get the model family specific arguments for generate
+        generation_arguments = prompt_funcs.generation_arguments(
+            self.model_type,
+            self.tokenizer,
+            generation_configuration
+        )
 
-        # Reset cuda memory stats
-        torch.cuda.reset_peak_memory_stats()
+        # Find the number of beams generate will actually use
+        num_beams = generation_arguments.get('generation_config', self.model.generation_config).num_beams
 
-        # Start generation timer
-        generation_start_time = time.time()
+        # Set up streaming of partial replies, if asked for. Streaming
+        # is not supported with beam search, since the beams can change
+        # which tokens are kept
+        streamer = None
 
-        # Select and prompt model: mistral
-        if user.model_type in conf.mistral_family_models:
+        if conf.stream_responses == True and stream_queue is not None and num_beams == 1:
+            streamer = streamer_class.Batch_streamer(self.tokenizer, self.model_type, users, stream_queue)
 
-            reply, num_tokens_generated = prompt_funcs.prompt_mistral(
-                input_messages, 
-                self.device_map, 
-                self.model, 
-                self.tokenizer,
-                user.generation_configurations[user.model_type]
-            )
+        # Pad the tokenized conversations into a batch
+        inputs = prompt_funcs.pad(batch_input_ids, self.tokenizer)
+        prompt_length = inputs['input_ids'].shape[-1]
+
+        # Reuse key values from the user's last turn if we can. Only for a single
+        # user, since left padding shifts each prompt in a batch by a different
+        # amount, and not with beam search, which reorders the cache between beams
+        use_kv_cache = conf.kv_cache == True and len(users) == 1 and num_beams == 1
+
+        # Use the draft model to propose tokens for the main model to check, if
+        # we have one. Generate only supports this for a single prompt without
+        # beam search. It doesn't take past key values, so the KV cache sits out.
+        use_draft_model = self.draft_model is not None and len(users) == 1 and num_beams == 1
 
-        # Select and prompt model: falcon
-        elif user.model_type in conf.falcon_family_models:
+        if use_draft_model == True:
+            generation_arguments['assistant_model'] = self.draft_model
+            use_kv_cache = False
 
-            reply, num_tokens_generated = prompt_funcs.prompt_falcon(
-                input_messages,
-                self.device_map,
-                self.model, 
-                self.tokenizer,
-                user.generation_configurations[user.model_type],
-                self.logger
+        if use_kv_cache == True:
+
+            past_key_values, prefix_length = self.kv_cache.get(
+                users[0],
+                inputs['input_ids'][0].tolist(),
+                self.model.device
             )
 
-        # Select and prompt model: dialo
-        elif user.model_type in conf.dialo_family_models:
+            # If the user's own cache doesn't cover the system prompt, i.e. on their
+            # first turn or after the input window slid, start from the shared
+            # system prompt cache instead
+            input_messages = batch_input_messages[0]
+
+            if input_messages[0]['role'] == 'system':
+
+                prompt = input_messages[0]['content']
+
+                if self.kv_cache.has_prompt(self.model_type, prompt) == False:
+                    self.cache_system_prompt(prompt)
+
+                prompt_past_key_values, prompt_prefix_length = self.kv_cache.get_prompt(
+                    self.model_type,
+                    prompt,
+                    inputs['input_ids'][0].tolist(),
+                    self.model.device
+                )
+
+                if prompt_prefix_length > prefix_length:
+                    past_key_values, prefix_length = prompt_past_key_values, prompt_prefix_length
+                    self.logger.debug('Using shared system prompt KV cache')
+
+            if past_key_values is not None:
+                generation_arguments['past_key_values'] = past_key_values
+
+            self.logger.info(f'Reusing {prefix_length} of {prompt_length} prompt tokens from KV cache')
+
+        # Move inputs to the device the model is actually on
+        inputs = inputs.to(self.model.device)
+
+        self.logger.info(f'Prompting {self.model_type} on {self.device_map} with batch of {len(users)}')
+
+        # Reset memory stats and get the starting point
+        start_memory = self.reset_memory_stats()
+
+        # Count forward passes through each model, to work out how many
+        # of the draft model's tokens the main model accepted
+        forward_passes = {'model': 0, 'draft_model': 0}
+        hook_handles = []
+
+        if use_draft_model == True:
+            hook_handles.append(self.model.register_forward_hook(
+                lambda module, args, output: forward_passes.update(model = forward_passes['model'] + 1)
+            ))
+
+            hook_handles.append(self.draft_model.register_forward_hook(
+                lambda module, args, output: forward_passes.update(draft_model = forward_passes['draft_model'] + 1)
+            ))
 
-            reply, num_tokens_generated = prompt_funcs.prompt_dialo(
-                input_messages,
-                self.device_map,
-                self.model, 
-                self.tokenizer
+        # Start generation timer
+        generation_start_time = time.time()
+
+        # Generate
+        try:
+            output = self.model.generate(
+                **inputs,
+                **generation_arguments,
+                streamer = streamer,
+                stopping_criteria = StoppingCriteriaList([stopping_criteria_class.Cancellation_criteria(cancellations)]),
+                return_dict_in_generate = True
             )
 
-        # Stop generation timer, calculate and log total generation time
+        finally:
+            for hook_handle in hook_handles:
+                hook_handle.remove()
+
+        # Stop generation timer
         dT = time.time() - generation_start_time
-        self.logger.info(f'{num_tokens_generated} tokens generated in {round(dT, 1)} seconds')
 
-        # Get and log peak GPU memory use
-        max_memory = torch.cuda.max_memory_allocated()
-        self.logger.info(f'Peak GPU memory use: {round(max_memory / 10**9, 1)} GB')
+        # Un-tokenize and parse the replies
+        replies, num_tokens_generated = prompt_funcs.decode_replies(
+            self.model_type,
+            self.tokenizer,
+            inputs['input_ids'],
+            output.sequences
+        )
+
+        # Keep the key values for the user's next turn. They cover the prompt
+        # and all but the last generated token.
+        if use_kv_cache == True and getattr(output, 'past_key_values', None) is not None:
+
+            past_key_values = output.past_key_values
+
+            if hasattr(past_key_values, 'to_legacy_cache'):
+                past_key_values = past_key_values.to_legacy_cache()
+
+            cache_length = past_key_values[0][0].shape[-2]
+            self.kv_cache.put(users[0], output.sequences[0][:cache_length].tolist(), past_key_values)
+
+        # Log total generation time
+        self.logger.info(f'{sum(num_tokens_generated)} tokens generated for {len(users)} users in {round(dT, 1)} seconds, {round(sum(num_tokens_generated) / max(dT, 1e-6), 1)} tokens/sec')
+
+        # Each pass through the main model checks the draft model's proposed
+        # tokens and adds one token of its own, so the rest were accepted drafts
+        if use_draft_model == True and forward_passes['draft_model'] > 0:
+
+            accepted_tokens = max(sum(num_tokens_generated) - forward_passes['model'], 0)
+            acceptance_rate = accepted_tokens / forward_passes['draft_model']
+
+            self.logger.info(f"Assisted decoding: {accepted_tokens} of {forward_passes['draft_model']} draft tokens accepted ({round(100 * acceptance_rate)}%), {forward_passes['model']} main model passes")
+
+        # Get and log peak memory use
+        max_memory = self.peak_memory()
+        self.logger.info(f'Peak memory use on {self.device_map}: {round(max_memory / 10**9, 1)} GB')
+
+        # Keep track of the most extra memory generation has needed,
+        # the model pool uses this to decide what fits on the device
+        self.generation_memory = max(self.generation_memory, max_memory - start_memory)
+
+        # Users with something for the listener
+        completed_users = []
+
+        for user, reply, (conversation_id, reply_position), cancellation in zip(users, replies, snapshots, cancellations):
+
+            # Drop replies which were cancelled while generating. If the reply
+            # was being streamed, the listener takes down the partial reply, a
+            # None reply tells it the generation was cancelled.
+            if cancellation is not None and cancellation.is_set() == True:
+                self.logger.info(f'Generation for {user.user_name} was cancelled, dropping reply')
+
+                if stream_queue is not None:
+                    user.replies.append(None)
+                    completed_users.append(user)
+
+                continue
+
+            # Format models reply as dict
+            model_message = {
+                'role': 'assistant',
+                'content': reply
+            }
 
-        # Format models reply as dict
-        model_message = {
-            'role': 'assistant',
-            'content': reply
-        }
+            # Add the reply to the users chat history right after the messages it
+            # answers, any sent while generating come after it. If the conversation
+            # was restarted while generating, the reply doesn't belong in the new one.
+            with user.lock:
+                if user.conversation_id == conversation_id:
+                    user.messages.insert(reply_position, model_message)
 
-        # Add the reply to the users chat history and log for debug
-        user.messages.append(model_message)
-        self.logger.debug(f'Model reply: {model_message}')
+            # Hand the reply to the listener to post and log for debug
+            user.replies.append(reply)
+            completed_users.append(user)
+            self.logger.debug(f'Model reply to {user.user_name}: {model_message}')
 
         # Done
-        return True
+        return completed_users
@@ -1,6 +1,7 @@
-import os
+import atexit
 from nio import AsyncClient
 import bartleby.configuration as conf
+import bartleby.classes.token_store_class as token_store_class
 
 class Matrix:
     '''Class to hold session objects related to matrix chat'''
@@ -17,6 +18,9 @@ class Matrix:
         # Add logger
         self.logger = logger
 
+        # Persists the next batch token in the background
+        self.next_batch_token_store = token_store_class.Token_store(self.next_batch_token_file, logger)
+
     def start_matrix_client(self):
 
         # Fire up the matrix client.
@@ -27,27 +31,88 @@ class Matrix:
 
         # Read the previously-written next batch token if it exists and feed it to the nio 
         # AsyncClient so that we don't see all prior messages in the room as 'new' events.
-        if os.path.isfile(self.next_batch_token_file):
-            with open (self.next_batch_token_file,'r') as next_batch_token:
-                self.async_client.next_batch = next_batch_token.read()
+        next_batch_token = self.next_batch_token_store.read()
 
-    async def post_message(self, user):
+        if next_batch_token is not None:
+            self.async_client.next_batch = next_batch_token
+
+        # Start writing new tokens in the background, and make sure
+        # the latest one is written when we shut down
+        self.next_batch_token_store.start()
+        atexit.register(self.next_batch_token_store.close)
+
+    def format_content(self, message, user_name):
+        '''Formats text as matrix message content mentioning the user'''
 
         # Get rid of any <strong> tags in message for unformatted body
-        body = user.messages[-1]['content'].replace('<strong>', '').replace('</strong>', '')
+        body = message.replace('<strong>', '').replace('</strong>', '')
 
         # Replace \n with html <br> for formatted body
-        formatted_body = user.messages[-1]['content'].replace('\n', '<br>')
+        formatted_body = message.replace('\n', '<br>')
 
         # Format output as matrix message
         content = {
             'msgtype': 'm.text',
             'format': 'org.matrix.custom.html',
-            'body': f'{user.user_name}: {body}',
-            'formatted_body': f'<a href="https://matrix.to/#/@{user.user_name}:perdrizet.org">{user.user_name}</a>: {formatted_body}',
-            'm.mentions': {'user_ids': [f'@{user.user_name}:perdrizet.org']}
+            'body': f'{user_name}: {body}',
+            'formatted_body': f'<a href="https://matrix.to/#/@{user_name}:perdrizet.org">{user_name}</a>: {formatted_body}',
+            'm.mentions': {'user_ids': [f'@{user_name}:perdrizet.org']}
         }
 
+        return content
+
+    def format_replacement_content(self, message, user_name, event_id):
+        '''Formats text as an m.replace edit of a previously posted message'''
+
+        new_content = self.format_content(message, user_name)
+
+        # Clients which don't understand edits show the fallback body,
+        # marked with a '*' like other clients do
+        content = {
+            'msgtype': 'm.text',
+            'format': 'org.matrix.custom.html',
+            'body': f"* {new_content['body']}",
+            'formatted_body': f"* {new_content['formatted_body']}",
+            'm.new_content': new_content,
+            'm.relates_to': {
+                'rel_type': 'm.replace',
+                'event_id': event_id
+            }
+        }
+
+        return content
+
+    async def post_message(self, user):
+
+        # Get the reply text and clear the partial reply so that
+        # any late stream updates are ignored
+        reply = user.replies.popleft()
+        user.partial_reply = None
+
+        # If the generation was cancelled, redact the partial reply if one
+        # was posted. One still being sent is redacted once it is.
+        if reply is None:
+
+            if user.stream_message is not None:
+                _ = await self.async_client.room_redact(
+                    self.matrix_room_id,
+                    user.stream_message,
+                    reason = 'Reply cancelled'
+                )
+
+                user.stream_message = None
+
+            return True
+
+        # If the reply was streamed, edit the placeholder message,
+        # otherwise post a new one
+        if user.stream_message is not None:
+            content = self.format_replacement_content(reply, user.user_name, user.stream_message)
+            user.stream_message = None
+
+        else:
+            content = self.format_content(reply, user.user_name)
+
         # Post message to room
         _ = await self.async_client.room_send(
             self.matrix_room_id, 
@@ -62,23 +127,56 @@ class Matrix:
         )
 
         return True
-    
-    async def post_system_message(self, message, user_name):
 
-        # Get rid of any <strong> tags in message for unformatted body
-        body = message.replace('<strong>', '').replace('</strong>', '')
+    async def post_partial_message(self, user):
+        '''Posts or updates the placeholder message for a reply which
+        is still being generated'''
 
-        # Replace \n with html <br> for formatted body
-        formatted_body = message.replace('\n', '<br>')
+        # Skip users whose complete reply has already been posted
+        partial_reply = user.partial_reply
+
+        if partial_reply is None:
+            return False
+
+        # Post the placeholder and keep its event id for later edits
+        if user.stream_message is None:
+            content = self.format_content(partial_reply, user.user_name)
+
+            response = await self.async_client.room_send(
+                self.matrix_room_id,
+                'm.room.message',
+                content
+            )
+
+            # If the complete reply was posted while we were sending the
+            # placeholder, it went out as its own message, so take the
+            # placeholder down and don't keep its event id
+            if user.partial_reply is None:
+                _ = await self.async_client.room_redact(
+                    self.matrix_room_id,
+                    response.event_id,
+                    reason = 'Replaced by complete reply'
+                )
+
+            else:
+                user.stream_message = response.event_id
+
+        # Or, edit the placeholder
+        else:
+            content = self.format_replacement_content(partial_reply, user.user_name, user.stream_message)
+
+            _ = await self.async_client.room_send(
+                self.matrix_room_id,
+                'm.room.message',
+                content
+            )
+
+        return True
+
+    async def post_system_message(self, message, user_name):
 
         # Format output as matrix message
-        content = {
-            'msgtype': 'm.text',
-            'format': 'org.matrix.custom.html',
-            'body': f'{user_name}: {body}',
-            'formatted_body': f'<a href="https://matrix.to/#/@{user_name}:perdrizet.org">{user_name}</a>: {formatted_body}',
-            'm.mentions': {'user_ids': [f'@{user_name}:perdrizet.org']}
-        }
+        content = self.format_content(message, user_name)
 
         # Post message to room
         _ = await self.async_client.room_send(
@@ -0,0 +1,99 @@
+import threading
+import bartleby.configuration as conf
+
+class Counter:
+    '''Class to count events and log the running total'''
+
+    def __init__(self, name, logger):
+
+        # Name to use in log messages
+        self.name = name
+        self.count = 0
+
+        # Counts can come from more than one thread
+        self.lock = threading.Lock()
+
+        # Add logger
+        self.logger = logger
+
+    def increment(self, amount = 1):
+        '''Adds to the count'''
+
+        with self.lock:
+            self.count += amount
+            count = self.count
+
+        self.logger.info(f'{self.name}: {count}')
+
+class Latency_histogram:
+    '''Class to collect latencies into buckets and periodically
+    log a summary'''
+
+    def __init__(self, name, logger):
+
+        # Name to use in log messages
+        self.name = name
+
+        # Upper bucket edges in seconds, plus one overflow bucket
+        self.bucket_edges = conf.latency_histogram_buckets
+        self.counts = [0] * (len(self.bucket_edges) + 1)
+
+        # Running totals
+        self.num_records = 0
+        self.total_time = 0
+        self.max_time = 0
+
+        # Log the histogram every this many records
+        self.log_interval = conf.latency_histogram_log_interval
+
+        # Records can come from more than one thread
+        self.lock = threading.Lock()
+
+        # Add logger
+        self.logger = logger
+
+    def record(self, latency):
+        '''Adds a latency in seconds to the histogram'''
+
+        with self.lock:
+
+            # Find the first bucket the latency fits in
+            bucket = len(self.bucket_edges)
+
+            for i, edge in enumerate(self.bucket_edges):
+                if latency <= edge:
+                    bucket = i
+                    break
+
+            self.counts[bucket] += 1
+            self.num_records += 1
+            self.total_time += latency
+            self.max_time = max(self.max_time, latency)
+
+            log_now = self.num_records % self.log_interval == 0
+
+        self.logger.debug(f'{self.name} latency: {round(latency, 3)}s')
+
+        if log_now == True:
+            self.logger.info(self.summary())
+
+    def summary(self):
+        '''Returns histogram formatted as string for logging'''
+
+        with self.lock:
+
+            buckets = []
+            lower_edge = 0
+
+            for edge, count in zip(self.bucket_edges, self.counts):
+                buckets.append(f'{lower_edge}-{edge}s: {count}')
+                lower_edge = edge
+
+            buckets.append(f'>{lower_edge}s: {self.counts[-1]}')
+
+            mean_time = self.total_time / max(self.num_records, 1)
+
+            summary = f'{self.name} latency histogram ({self.num_records} calls, mean {round(mean_time, 3)}s, max {round(self.max_time, 3)}s): '
+            summary += ', '.join(buckets)
+
+        return summary
@@ -0,0 +1,391 @@
+import time
+import threading
+import bartleby.configuration as conf
+import bartleby.classes.llm_class as llm
+from concurrent.futures import ThreadPoolExecutor
+
+class Model_pool:
+    '''Class to hold the running LLMs. Models are loaded on a background
+    thread, so that neither the listeners nor generation for users of
+    models which are already running wait on a slow model load. Keeps
+    resident models within a GPU memory budget by evicting the least
+    recently used ones and reloading them on demand. Hot models can
+    run as several replicas on different devices.'''
+
+    def __init__(self, logger, scheduler, notification_queue):
+
+        # Lists of LLM class instances, one per replica, keyed by model type
+        self.llms = {}
+
+        # LLM class instances currently being loaded or restored,
+        # and ones being evicted which can't be restored until done
+        self.loading = set()
+        self.evicting = set()
+
+        # Devices to place models on and any fixed placements
+        # of model types to devices
+        self.devices = conf.devices
+        self.model_placement = conf.model_placement
+
+        # Number of replicas to run for each model type, default is one
+        self.model_replicas = conf.model_replicas
+
+        # GPU and CPU memory budgets per device for resident models
+        # in bytes and where evicted models go: 'cpu' or 'disk'
+        self.memory_budget = conf.gpu_memory_budget * 10**9
+        self.cpu_memory_budget = conf.CPU_memory_budget * 10**9
+        self.eviction_target = conf.model_eviction_target
+
+        # Listeners, the generator and the loader threads all touch the pool
+        self.lock = threading.Lock()
+
+        # Worker threads for loading models
+        self.executor = ThreadPoolExecutor(
+            max_workers = conf.model_loader_workers,
+            thread_name_prefix = 'model_loader'
+        )
+
+        # Scheduler holding the generation queue, told when a model
+        # is ready so that parked users can be scheduled
+        self.scheduler = scheduler
+
+        # Queue to tell users waiting on a model which failed to load
+        self.notification_queue = notification_queue
+
+        # Failed loads in a row for each model type, a model which has no
+        # replicas left is requested again up to the retry limit
+        self.load_failures = {}
+        self.load_retries = conf.model_load_retries
+
+        # When utilisation stats were last logged
+        self.stats_interval = conf.replica_stats_log_interval
+        self.stats_time = time.time()
+
+        # Add logger
+        self.logger = logger
+
+    def request(self, model_type):
+        '''Returns the list of LLM class instance replicas for a model type. If
+        we don't have them, creates them and starts loading the models in the
+        background. If any were evicted, starts restoring them. The instances'
+        generation configuration is available right away, each is ready for
+        generation once its ready event is set. Raises ValueError for a model
+        type which is not supported.'''
+
+        if model_type not in conf.supported_models:
+            raise ValueError(f'Unsupported model {model_type}')
+
+        with self.lock:
+
+            if model_type not in self.llms:
+
+                # Each device has one generator, which only uses one replica of
+                # a model, so there can't be more replicas than devices. A fixed
+                # placement puts the model on one device, so it gets one replica.
+                num_replicas = self.model_replicas.get(model_type, 1)
+
+                if model_type in self.model_placement:
+                    max_replicas = 1
+
+                else:
+                    max_replicas = len(self.devices)
+
+                if num_replicas > max_replicas:
+                    self.logger.warning(f'Asked for {num_replicas} replicas of {model_type}, running {max_replicas}, one per device')
+                    num_replicas = max_replicas
+
+                # Instantiate the llm class instances on their devices and read
+                # the generation configuration. Reading it can fail, so only add
+                # them to the pool once they all have it, otherwise the next
+                # request would find an empty list rather than try again.
+                replicas = []
+
+                for replica in range(num_replicas):
+
+                    device = self.place(model_type, replicas)
+                    llm_instance = llm.Llm(self.logger, device)
+                    llm_instance.initialize_generation_configuration(model_type)
+                    replicas.append(llm_instance)
+
+                self.llms[model_type] = replicas
+
+            replicas = list(self.llms[model_type])
+
+        for llm_instance in replicas:
+            self.start_loading(llm_instance)
+
+        return replicas
+
+    def start_loading(self, llm_instance):
+        '''Starts loading or restoring a replica in the background, unless
+        it's resident or already on its way'''
+
+        with self.lock:
+
+            if llm_instance.ready.is_set() or llm_instance in self.loading or llm_instance in self.evicting:
+                return
+
+            self.loading.add(llm_instance)
+
+        # Load the model weights in the background
+        self.executor.submit(self.load, llm_instance)
+        self.logger.info(f'Started loading {llm_instance.model_type} on {llm_instance.device_map} in the background')
+
+    def load(self, llm_instance):
+        '''Loads or restores an LLM's model, run on the loader threads'''
+
+        load_start_time = time.time()
+
+        # Evict other models if needed to make room. The first time a model is
+        # loaded its footprint is unknown, so this is re-checked after the load
+        self.make_room(llm_instance)
+
+        try:
+            if llm_instance.evicted == True:
+                llm_instance.restore()
+
+            else:
+                llm_instance.load_model()
+
+        # If the load fails, take the replica out of the pool so that
+        # the next request for this model type tries again
+        except Exception as error:
+            self.logger.error(f'Failed to load {llm_instance.model_type} on {llm_instance.device_map}: {error}')
+            self.load_failed(llm_instance, error)
+            return
+
+        with self.lock:
+            self.loading.discard(llm_instance)
+            llm_instance.last_used = time.time()
+            self.load_failures[llm_instance.model_type] = 0
+
+        self.logger.info(f'Loaded {llm_instance.model_type} on {llm_instance.device_map} in {round(time.time() - load_start_time, 1)} seconds, footprint {round(llm_instance.memory_footprint() / 10**9, 1)} GB')
+
+        # Now that the footprint is known, make sure we are within budget
+        self.make_room(llm_instance)
+
+        # Let the scheduler know so that any users waiting on this model get scheduled
+        self.scheduler.notify()
+
+    def load_failed(self, llm_instance, error):
+        '''Takes a replica which failed to load out of the pool. If that was the
+        model's last replica, users are waiting on a model which will never be
+        ready, so it's requested again. Once out of retries, the waiting users
+        are taken out of the queue and told.'''
+
+        model_type = llm_instance.model_type
+
+        with self.lock:
+            self.loading.discard(llm_instance)
+            replicas = self.llms.get(model_type, [])
+
+            if llm_instance in replicas:
+                replicas.remove(llm_instance)
+
+            # Other replicas can still serve the waiting users
+            if len(replicas) > 0:
+                return
+
+            self.llms.pop(model_type, None)
+
+            failures = self.load_failures.get(model_type, 0) + 1
+            self.load_failures[model_type] = failures
+
+            # Start afresh the next time a user asks for it
+            if failures > self.load_retries:
+                self.load_failures[model_type] = 0
+
+        if failures <= self.load_retries:
+            self.logger.warning(f'Retrying load of {model_type}, retry {failures} of {self.load_retries}')
+
+            try:
+                _ = self.request(model_type)
+                return
+
+            # If the model can't even be set up again, give up on it now
+            except Exception as retry_error:
+                self.logger.error(f'Failed to retry load of {model_type}: {retry_error}')
+                error = retry_error
+
+                with self.lock:
+                    self.load_failures[model_type] = 0
+
+        for queued_user in self.scheduler.drop_model(model_type):
+            self.notification_queue.put((queued_user, f'Sorry, {model_type} failed to load: {error}', None))
+            self.logger.info(f'Dropped {queued_user.user_name} from queue, {model_type} failed to load')
+
+    def place(self, model_type, replicas):
+        '''Picks a device for a model type given the replicas placed so far,
+        caller must hold the lock. Uses the fixed placement from the configuration
+        file if there is one. Otherwise picks the device with the least memory
+        committed to other models out of those which don't already have a
+        replica of this model.'''
+
+        if model_type in self.model_placement:
+            return self.model_placement[model_type]
+
+        replica_devices = [llm_instance.device_map for llm_instance in replicas]
+        committed_memory = {device: 0 for device in self.devices if device not in replica_devices}
+
+        for llm_instance in self.instances():
+            if llm_instance.device_map in committed_memory and llm_instance.evicted == False:
+                committed_memory[llm_instance.device_map] += llm_instance.memory_footprint()
+
+        return min(committed_memory, key=lambda device: committed_memory[device])
+
+    def instances(self):
+        '''Returns flat list of all replicas of all models, caller must hold the lock'''
+
+        return [llm_instance for replicas in self.llms.values() for llm_instance in replicas]
+
+    def make_room(self, llm_instance):
+        '''Evicts least recently used models on the same device which are not
+        generating until the given model's footprint fits in the device's memory
+        budget. The models to evict are picked under the lock, but evicted
+        outside of it, so that the listeners and generators don't wait on it.'''
+
+        if llm_instance.on_cpu() == True:
+            memory_budget = self.cpu_memory_budget
+
+        else:
+            memory_budget = self.memory_budget
+
+        evicted_instances = []
+
+        with self.lock:
+
+            while True:
+
+                # Add up the footprints of the other resident models
+                resident_memory = 0
+                candidates = []
+
+                for other_instance in self.instances():
+                    if other_instance is not llm_instance and other_instance.device_map == llm_instance.device_map and other_instance.ready.is_set():
+
+                        resident_memory += other_instance.memory_footprint()
+
+                        if other_instance.active_generations == 0:
+                            candidates.append(other_instance)
+
+                if resident_memory + llm_instance.memory_footprint() <= memory_budget:
+                    break
+
+                if len(candidates) == 0:
+                    self.logger.warning(f'Over memory budget on {llm_instance.device_map} with {llm_instance.model_type}, nothing left to evict')
+                    break
+
+                # Take the least recently used out of service now, so it can't be
+                # checked out for generation or restored while it's evicted
+                evicted_instance = min(candidates, key=lambda candidate: candidate.last_used)
+                evicted_instance.ready.clear()
+                self.evicting.add(evicted_instance)
+                evicted_instances.append(evicted_instance)
+
+        # Moving or dropping the weights and collecting garbage can take seconds
+        for evicted_instance in evicted_instances:
+
+            try:
+                evicted_instance.evict(self.eviction_target)
+
+            finally:
+                with self.lock:
+                    self.evicting.discard(evicted_instance)
+
+            self.logger.info(f'Evicted {evicted_instance.model_type} on {evicted_instance.device_map} to {self.eviction_target} to make room for {llm_instance.model_type}')
+
+        # Users may be waiting on the evicted models, wake the
+        # generators so they start restoring them
+        if len(evicted_instances) > 0:
+            self.scheduler.notify()
+
+    def prewarm(self, model_types):
+        '''Starts loading a list of models ahead of any users asking for them'''
+
+        for model_type in model_types:
+
+            if model_type in conf.supported_models:
+                _ = self.request(model_type)
+
+            else:
+                self.logger.error(f'Not pre-warming unsupported model {model_type}')
+
+    def replica(self, model_type, device):
+        '''Returns the replica of a model type on a device, or None'''
+
+        with self.lock:
+            for llm_instance in self.llms.get(model_type, []):
+                if llm_instance.device_map == device:
+                    return llm_instance
+
+        return None
+
+    def is_ready(self, model_type, device):
+        '''Checks if a model type has a replica loaded on a device and ready for
+        generation. If it was evicted while users were waiting for it, starts
+        restoring it.'''
+
+        llm_instance = self.replica(model_type, device)
+
+        if llm_instance is None:
+            return False
+
+        if llm_instance.evicted == True:
+            self.start_loading(llm_instance)
+
+        return llm_instance.ready.is_set()
+
+    def get(self, model_type):
+        '''Returns the list of LLM class instance replicas for a model type'''
+
+        with self.lock:
+            return list(self.llms[model_type])
+
+    def checkout(self, model_type, device):
+        '''Marks a model's replica on a device as generating so it won't be
+        evicted and returns it. Returns None if it was evicted since it was
+        scheduled.'''
+
+        llm_instance = self.replica(model_type, device)
+
+        with self.lock:
+
+            if llm_instance is None or llm_instance.ready.is_set() == False:
+                return None
+
+            llm_instance.active_generations += 1
+            llm_instance.last_used = time.time()
+            llm_instance.busy_since = llm_instance.last_used
+
+        return llm_instance
+
+    def checkin(self, llm_instance):
+        '''Marks a generation on a model as done'''
+
+        with self.lock:
+            llm_instance.active_generations -= 1
+            llm_instance.last_used = time.time()
+            llm_instance.busy_time += llm_instance.last_used - llm_instance.busy_since
+
+    def log_stats(self, queue_depth):
+        '''Logs queue depth and the fraction of time each replica spent
+        generating since the last time stats were logged, at most once
+        per stats interval'''
+
+        with self.lock:
+
+            stats_time = time.time()
+            elapsed_time = stats_time - self.stats_time
+
+            if elapsed_time < self.stats_interval:
+                return
+
+            self.stats_time = stats_time
+
+            utilisation = []
+
+            for llm_instance in self.instances():
+                utilisation.append(f'{llm_instance.model_type} on {llm_instance.device_map}: {round(100 * llm_instance.busy_time / elapsed_time)}%')
+                llm_instance.busy_time = 0
+
+        self.logger.info(f'Generation queue depth: {queue_depth}, replica utilisation: {", ".join(utilisation)}')
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+class Response_queue:
+    '''Class to hand users from the generator threads to a listener's
+    asyncio event loop. Users put on the queue wake the listener right
+    away, instead of waiting for it to poll.'''
+
+    def __init__(self):
+
+        # The listener's event loop and its queue, set when the listener attaches
+        self.loop = None
+        self.queue = None
+
+        # Users put before the listener attached
+        self.backlog = []
+
+        # Generator threads and the listener both touch the loop and backlog
+        self.lock = threading.Lock()
+
+    def attach(self, loop):
+        '''Binds the queue to the listener's event loop, must be called
+        from a coroutine running on that loop'''
+
+        with self.lock:
+
+            self.loop = loop
+            self.queue = asyncio.Queue()
+
+            # Hand over anything which arrived before we attached
+            for item in self.backlog:
+                self.queue.put_nowait(item)
+
+            self.backlog = []
+
+    def put(self, item):
+        '''Adds item to the queue, safe to call from any thread'''
+
+        with self.lock:
+
+            if self.loop is None:
+                self.backlog.append(item)
+
+            else:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def get(self):
+        '''Waits for the next item, called from the listener's event loop'''
+
+        return await self.queue.get()
+
+    def get_nowait(self):
+        '''Returns the next item without waiting, raises asyncio.QueueEmpty
+        if there isn't one. Called from the listener's event loop.'''
+
+        return self.queue.get_nowait()
+
+    def empty(self):
+        '''Checks if there is anything waiting, called from the
+        listener's event loop'''
+
+        return self.queue.empty()
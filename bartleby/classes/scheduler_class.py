@@ -0,0 +1,325 @@
+import time
+import threading
+from collections import deque
+import bartleby.configuration as conf
+import bartleby.classes.metrics_class as metrics
+
+class Scheduler:
+    '''Class to hold the generation queue. Groups queued users
+    into batches which can share one call to the model. Shares
+    the GPU fairly between users by serving the user who has
+    received the least generation work first.'''
+
+    def __init__(self, logger):
+
+        # Batching settings
+        self.max_batch_size = conf.max_batch_size
+        self.max_batch_wait = conf.max_batch_wait
+
+        # How long a user waits for the replica holding their cached
+        # key values before any other replica can take them
+        self.sticky_wait = conf.replica_sticky_wait
+
+        # Users waiting for generation, in arrival order, paired
+        # with the time they were queued
+        self.pending = deque()
+
+        # Estimated generation work each user has received, keyed by
+        # user name. Users with the least work are served first.
+        self.service = {}
+
+        # Count of generations cancelled before or during generation
+        self.cancellations = metrics.Counter('Cancelled generations', logger)
+
+        # Condition to let the generator sleep until there is work
+        self.condition = threading.Condition()
+
+        # Add logger
+        self.logger = logger
+
+    def put(self, user):
+        '''Adds a user to the generation queue, called by the listeners. If the
+        user already has a generation waiting, it will pick up the new message
+        when it starts, so they are not queued again.'''
+
+        with self.condition:
+
+            # If asked to, stop the user's running generation, the new one
+            # will answer their follow up together with what came before
+            if conf.cancel_on_follow_up == True and user.running_cancellation is not None:
+                user.running_cancellation.set()
+                self.logger.info(f'Cancelled running generation for {user.user_name} on follow up message')
+
+            # A cancelled job stays in the queue until a generator drops it, so
+            # take it out now rather than fold the new message into it
+            if user.generation_pending == True and user.pending_cancellation.is_set() == True:
+                self.pending = deque(entry for entry in self.pending if entry[0] is not user)
+                user.generation_pending = False
+                user.pending_cancellation = None
+                self.cancellations.increment()
+                self.logger.info(f'Dropped cancelled generation for {user.user_name} from queue')
+
+            if user.generation_pending == True:
+                self.logger.info(f'Coalesced message from {user.user_name} into their queued generation')
+                return
+
+            user.generation_pending = True
+            user.pending_cancellation = threading.Event()
+
+            # A user who has been idle comes back level with the least served
+            # waiting user, so they can't bank credit while away
+            if len(self.pending) > 0:
+                least_service = min(self.service[queued_user.user_name] for queued_user, queue_time in self.pending)
+                self.service[user.user_name] = max(self.service.get(user.user_name, 0), least_service)
+
+            else:
+                self.service.setdefault(user.user_name, 0)
+
+            self.pending.append((user, time.time()))
+            self.condition.notify_all()
+
+    def requeue(self, users):
+        '''Puts a scheduled batch back in the queue without charging the
+        users for it, e.g. if their model was evicted before generation'''
+
+        with self.condition:
+
+            for user in users:
+                # Refund what was charged at dispatch, the cost worked out
+                # now may differ if the user's settings or chat changed
+                self.service[user.user_name] -= user.charged_cost
+                user.charged_cost = 0
+                user.generation_running = False
+
+                if user.generation_pending == False:
+                    user.generation_pending = True
+                    user.pending_cancellation = user.running_cancellation
+                    self.pending.appendleft((user, time.time()))
+
+                user.running_cancellation = None
+
+            self.condition.notify_all()
+
+    def finish(self, users):
+        '''Marks a batch's generations as done, so that users who sent
+        more messages while generating can be scheduled again'''
+
+        with self.condition:
+
+            for user in users:
+
+                if user.running_cancellation.is_set() == True:
+                    self.cancellations.increment()
+
+                user.generation_running = False
+                user.running_cancellation = None
+
+            self.condition.notify_all()
+
+    def drop_cancelled(self):
+        '''Takes users whose queued generation was cancelled out of the
+        queue, caller must hold the condition'''
+
+        remaining_users = deque()
+
+        for queued_user, queue_time in self.pending:
+
+            if queued_user.pending_cancellation.is_set() == True:
+                queued_user.generation_pending = False
+                queued_user.pending_cancellation = None
+                self.cancellations.increment()
+                self.logger.info(f'Dropped cancelled generation for {queued_user.user_name} from queue')
+
+            else:
+                remaining_users.append((queued_user, queue_time))
+
+        self.pending = remaining_users
+
+    def drop_model(self, model_type):
+        '''Takes users waiting for a model type out of the queue, e.g. when
+        the model failed to load. Returns the users.'''
+
+        with self.condition:
+
+            dropped_users = []
+            remaining_users = deque()
+
+            for queued_user, queue_time in self.pending:
+
+                if queued_user.model_type == model_type:
+                    queued_user.generation_pending = False
+                    queued_user.pending_cancellation = None
+                    dropped_users.append(queued_user)
+
+                else:
+                    remaining_users.append((queued_user, queue_time))
+
+            self.pending = remaining_users
+            self.condition.notify_all()
+
+        return dropped_users
+
+    def job_cost(self, user):
+        '''Returns estimated cost of a user's generation: decoding work
+        scaled by the number of beams, plus prefill work for the prompt'''
+
+        generation_configuration = user.generation_configurations[user.model_type]
+
+        num_beams = getattr(generation_configuration, 'num_beams', 1)
+        max_new_tokens = getattr(generation_configuration, 'max_new_tokens', None)
+
+        if max_new_tokens is None:
+            max_new_tokens = conf.max_new_tokens
+
+        # Estimate prompt tokens from the length of the input messages at
+        # about four characters per token, prefill is much cheaper per
+        # token than decoding so it's weighted down
+        input_messages = user.messages[-user.model_input_buffer_size:]
+        prompt_tokens = sum(len(message['content']) for message in input_messages) / 4
+
+        return num_beams * max_new_tokens + conf.prompt_token_cost * prompt_tokens
+
+    def depth(self):
+        '''Returns the number of users waiting for generation'''
+
+        with self.condition:
+            return len(self.pending)
+
+    def batch_key(self, user):
+        '''Returns key used to decide if two users can share a batch. Users
+        need the same model and the same generation configuration.'''
+
+        generation_configuration = user.generation_configurations[user.model_type]
+
+        # Use the repr of each parameter so that values which are not
+        # hashable (tuples of lists, torch dtypes etc.) can still be compared
+        parameters = tuple(sorted(
+            (key, repr(value)) for key, value in vars(generation_configuration).items()
+        ))
+
+        return (user.model_type, parameters)
+
+    def notify(self):
+        '''Wakes the generator, e.g. when a model finishes loading'''
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def is_ready(self, user, queue_time, model_pool, device):
+        '''Checks if a queued user can be scheduled on a device: their model is
+        loaded there and they have a generation configuration for it. Users who
+        swapped to a model which is still loading are parked until it's ready.'''
+
+        # One generation at a time per user
+        if user.generation_running == True:
+            return False
+
+        if self.is_sticky(user, queue_time, device) == True:
+            return False
+
+        return model_pool.is_ready(user.model_type, device) and user.model_type in user.generation_configurations
+
+    def is_sticky(self, user, queue_time, device):
+        '''Checks if a user should wait for the replica on another device which
+        holds their cached key values, rather than be prefilled again here'''
+
+        replica = user.replica
+
+        if replica is None or replica.model_type != user.model_type or replica.device_map == device:
+            return False
+
+        if replica.ready.is_set() == False or user.user_name not in replica.kv_cache.entries:
+            return False
+
+        return time.time() - queue_time < self.sticky_wait
+
+    def fair_order(self):
+        '''Returns the queue ordered by how much work each user has received,
+        least first, with ties going to whoever has waited longest. Caller
+        must hold the condition.'''
+
+        self.drop_cancelled()
+
+        return sorted(
+            self.pending,
+            key = lambda entry: (self.service[entry[0].user_name], entry[1])
+        )
+
+    def next_ready_user(self, model_pool, device):
+        '''Returns the queued user who should be served next on a device, or None'''
+
+        for queued_user, queue_time in self.fair_order():
+            if self.is_ready(queued_user, queue_time, model_pool, device):
+                return queued_user
+
+        return None
+
+    def next_batch(self, model_pool, device):
+        '''Called by the generator worker for a device. Blocks until at least one
+        user whose model is ready on the device is waiting, then gives other users
+        a short window to arrive. Returns a list of users with compatible model
+        type and generation configuration, least served first.'''
+
+        with self.condition:
+
+            first_user = None
+
+            # While the batch is held open the user who was ready may be cancelled,
+            # taken by another device's generator or have their model evicted,
+            # if nobody is ready by the end of the window go back to waiting
+            while first_user is None:
+
+                # Sleep until something is queued for a model which is ready on this device.
+                # Wake up every sticky wait period so that users held for a busy
+                # replica elsewhere can be taken once they have waited long enough
+                while self.next_ready_user(model_pool, device) is None:
+                    self.condition.wait(self.sticky_wait)
+
+                # Hold the batch open for a short time so that users arriving
+                # together can share a call to the model
+                deadline = time.time() + self.max_batch_wait
+
+                while len(self.pending) < self.max_batch_size:
+
+                    remaining_time = deadline - time.time()
+
+                    if remaining_time <= 0:
+                        break
+
+                    self.condition.wait(remaining_time)
+
+                first_user = self.next_ready_user(model_pool, device)
+
+            # The least served ready user sets the bucket for this batch
+            key = self.batch_key(first_user)
+
+            batch = []
+
+            for queued_user, queue_time in self.fair_order():
+
+                # Take users from the same bucket up to the batch size
+                if len(batch) < self.max_batch_size and self.is_ready(queued_user, queue_time, model_pool, device) and self.batch_key(queued_user) == key:
+
+                    batch.append(queued_user)
+                    self.pending.remove((queued_user, queue_time))
+
+                    # Free the pending slot, messages from here on go to the next generation
+                    queued_user.generation_pending = False
+                    queued_user.generation_running = True
+
+                    # The queued job's cancellation event goes with it. Set the
+                    # running one first, so a cancel between the two lines still
+                    # finds it.
+                    queued_user.running_cancellation = queued_user.pending_cancellation
+                    queued_user.pending_cancellation = None
+
+                    # Charge the user for the work
+                    job_cost = self.job_cost(queued_user)
+                    self.service[queued_user.user_name] += job_cost
+                    queued_user.charged_cost = job_cost
+
+                    self.logger.info(f'{queued_user.user_name} waited {round(time.time() - queue_time, 2)}s for generation, estimated cost {round(job_cost)}')
+
+        self.logger.info(f'Scheduled batch of {len(batch)} for {key[0]} on {device}, {len(self.pending)} still queued')
+
+        return batch
@@ -0,0 +1,19 @@
+from transformers import StoppingCriteria
+
+class Cancellation_criteria(StoppingCriteria):
+    '''Stopping criteria passed to model.generate. Checked after every
+    new token, stops generation once every user in the batch has
+    cancelled so that the GPU is freed right away'''
+
+    def __init__(self, cancellations):
+
+        # Cancellation events for the users in the batch, in row order
+        self.cancellations = cancellations
+
+    def __call__(self, input_ids, scores, **kwargs):
+
+        for cancellation in self.cancellations:
+            if cancellation is None or cancellation.is_set() == False:
+                return False
+
+        return True
@@ -0,0 +1,73 @@
+import time
+import bartleby.configuration as conf
+import bartleby.functions.model_prompting_functions as prompt_funcs
+from transformers.generation.streamers import BaseStreamer
+
+class Batch_streamer(BaseStreamer):
+    '''Streamer passed to model.generate. Collects new tokens for each
+    user in the batch and, at a throttled cadence, puts users with updated
+    partial replies on the stream queue for the listener to post'''
+
+    def __init__(self, tokenizer, model_type, users, stream_queue):
+
+        # Tokenizer used to decode partial replies and model
+        # type, used to pick how to parse them
+        self.tokenizer = tokenizer
+        self.model_type = model_type
+
+        # Users in the batch, in row order, and the queue to send them on
+        self.users = users
+        self.stream_queue = stream_queue
+
+        # Generate sends the prompt first, we don't want to stream that
+        self.skip_prompt = True
+
+        # New token IDs for each row in the batch
+        self.token_ids = [[] for user in users]
+
+        # Time of the last update sent to the listener
+        self.update_interval = conf.stream_update_interval
+        self.last_update_time = time.time()
+
+    def put(self, value):
+        '''Called by generate with the prompt, then with each new token'''
+
+        if self.skip_prompt == True:
+            self.skip_prompt = False
+            return
+
+        # Add the new token to each row. Assisted decoding can
+        # send several new tokens at once, one row at a time
+        if value.dim() == 2:
+            for row, token_ids in enumerate(value.tolist()):
+                self.token_ids[row].extend(token_ids)
+
+        else:
+            for row, token_id in enumerate(value.tolist()):
+                self.token_ids[row].append(token_id)
+
+        # Only send updates at the configured cadence
+        if time.time() - self.last_update_time >= self.update_interval:
+            self.send_update()
+
+    def end(self):
+        '''Called by generate when it is done. The complete reply is sent
+        via the response queue, so there is nothing left to do here.'''
+
+        pass
+
+    def send_update(self):
+        '''Decodes partial replies and puts the users on the stream queue'''
+
+        self.last_update_time = time.time()
+
+        for user, token_ids in zip(self.users, self.token_ids):
+
+            # Decode everything generated so far for this user
+            text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+            partial_reply = prompt_funcs.parse_reply(self.model_type, text)
+
+            # Skip if there is nothing to show yet
+            if len(partial_reply) > 0:
+                user.partial_reply = partial_reply
+                self.stream_queue.put(user)
@@ -1,5 +1,10 @@
-import torch
+import time
+import queue
+import asyncio
+import threading
 import bartleby.configuration as conf
+import bartleby.classes.metrics_class as metrics
+from concurrent.futures import ThreadPoolExecutor
 from transformers import T5Tokenizer, T5ForConditionalGeneration
 
 class System_agent:
@@ -7,10 +12,6 @@ class System_agent:
 
     def __init__(self, logger):
 
-        # Give torch the requested CPU resources
-        torch.set_num_threads(conf.CPU_threads)
-        logger.info(f'Assigned {conf.CPU_threads} CPU threads')
-
         # Add logger
         self.logger = logger
 
@@ -20,24 +21,138 @@ class System_agent:
 
         self.system_agent_model = T5ForConditionalGeneration.from_pretrained(
             'gperdrizet/T5-base-system-agent',
-            device_map='cpu'    
+            device_map='cpu'
         )
 
-        self.output_sizer_tokenizer = T5Tokenizer.from_pretrained('google-t5/t5-small')
+        # All of the original T5 checkpoints share one sentencepiece
+        # vocabulary, so the output sizer can use the same tokenizer
+        # and messages only need to be tokenized once
+        self.output_sizer_tokenizer = self.system_agent_tokenizer
 
         self.output_sizer_model = T5ForConditionalGeneration.from_pretrained(
             'gperdrizet/T5-small-output-size-selector',
-            device_map='cpu'    
+            device_map='cpu'
+        )
+
+        # Messages waiting for classification, with the future
+        # and event loop to send the result back on
+        self.classification_queue = queue.Queue()
+
+        # Batching settings for classification
+        self.max_batch_size = conf.system_agent_max_batch_size
+        self.max_batch_wait = conf.system_agent_max_batch_wait
+
+        # Worker thread to run the output sizer on, so that it generates
+        # at the same time as the command translator
+        self.executor = ThreadPoolExecutor(
+            max_workers = 1,
+            thread_name_prefix = 'system_agent'
         )
 
-    def translate_command(self, message):
-        input_ids = self.system_agent_tokenizer(f'summarize: {message}', return_tensors='pt').input_ids
-        outputs = self.system_agent_model.generate(input_ids, max_new_tokens=10)
+        # Latency histogram for the classifier calls
+        self.classification_latency = metrics.Latency_histogram('System agent classification', logger)
+
+        # Start the classifier worker. Models run here, off of the
+        # listener's event loop, so that it is not blocked
+        self.classifier_thread = threading.Thread(target=self.classifier_worker, daemon=True)
+        self.classifier_thread.start()
+
+    async def classify(self, message, size_output = True):
+        '''Takes user message, returns the command it translates to and the
+        output size label. Callers which don't use the output size can skip
+        it, the label is then None. Awaitable from the listener's event loop.'''
+
+        start_time = time.time()
+
+        # Queue the message for the classifier worker and wait for the result
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.classification_queue.put((message, size_output, future, loop))
+
+        command, output_size = await future
+
+        self.classification_latency.record(time.time() - start_time)
+
+        return command, output_size
+
+    def classifier_worker(self):
+        '''Takes batches of messages from the classification queue and
+        runs the models on them'''
+
+        while True:
+
+            # Wait for a message, then give others a short window to join the batch
+            batch = [self.classification_queue.get()]
+            deadline = time.time() + self.max_batch_wait
+
+            while len(batch) < self.max_batch_size:
+
+                remaining_time = deadline - time.time()
+
+                if remaining_time <= 0:
+                    break
+
+                try:
+                    batch.append(self.classification_queue.get(timeout=remaining_time))
+
+                except queue.Empty:
+                    break
+
+            messages = [message for message, size_output, future, loop in batch]
+            size_outputs = [size_output for message, size_output, future, loop in batch]
+
+            try:
+                commands, output_sizes = self.classify_batch(messages, size_outputs)
+
+            # Send any failure back to the listeners rather than killing the worker
+            except Exception as error:
+                self.logger.error(f'System agent classification failed: {error}')
+
+                for message, size_output, future, loop in batch:
+                    loop.call_soon_threadsafe(future.set_exception, error)
+
+                continue
+
+            # Send the results back to the listeners' event loops
+            for (message, size_output, future, loop), command, output_size in zip(batch, commands, output_sizes):
+                loop.call_soon_threadsafe(future.set_result, (command, output_size))
+
+    def classify_batch(self, messages, size_outputs):
+        '''Takes list of messages and whether each wants an output size,
+        returns lists of commands and output size labels, None where not
+        wanted. Tokenizes once and runs both models at the same time.'''
+
+        self.logger.debug(f'System agent classifying batch of {len(messages)}')
+
+        # Tokenize the batch once for both models
+        inputs = self.system_agent_tokenizer(
+            [f'summarize: {message}' for message in messages],
+            padding = True,
+            return_tensors = 'pt'
+        )
+
+        # Start the output sizer in the background, only on the
+        # messages which want an output size
+        sized = [index for index, size_output in enumerate(size_outputs) if size_output == True]
+        output_sizer_future = None
+
+        if len(sized) > 0:
+            output_sizer_future = self.executor.submit(
+                self.output_sizer_model.generate,
+                **{key: value[sized] for key, value in inputs.items()},
+                max_new_tokens = 10
+            )
+
+        # Run the command translator here
+        system_agent_outputs = self.system_agent_model.generate(**inputs, max_new_tokens=10)
+        commands = self.system_agent_tokenizer.batch_decode(system_agent_outputs, skip_special_tokens=True)
+
+        output_sizes = [None] * len(messages)
+
+        if output_sizer_future is not None:
+            output_sizer_outputs = output_sizer_future.result()
 
-        return self.system_agent_tokenizer.decode(outputs[0], skip_special_tokens=True)
-    
-    def select_output_size(self, message):
-        input_ids = self.output_sizer_tokenizer(f'summarize: {message}', return_tensors='pt').input_ids
-        outputs = self.output_sizer_model.generate(input_ids, max_new_tokens=10)
+            for index, output_size in zip(sized, self.output_sizer_tokenizer.batch_decode(output_sizer_outputs, skip_special_tokens=True)):
+                output_sizes[index] = output_size
 
-        return self.output_sizer_tokenizer.decode(outputs[0], skip_special_tokens=True)
\ No newline at end of file
+        return commands, output_sizes
@@ -0,0 +1,114 @@
+import os
+import threading
+import bartleby.configuration as conf
+
+class Token_store:
+    '''Class to persist the matrix next batch token between restarts. Keeps
+    the latest token in memory and writes it to disk from a background
+    thread, only when it has changed and at most once per write interval,
+    so that the listener's event loop never waits on file IO.'''
+
+    def __init__(self, token_file, logger):
+
+        # File to persist the token to
+        self.token_file = token_file
+
+        # Minimum time in seconds between writes
+        self.write_interval = conf.next_batch_token_write_interval
+
+        # Latest token and the last one written to disk
+        self.token = None
+        self.written_token = None
+
+        # The listener updates the token, the writer thread reads it
+        self.lock = threading.Lock()
+
+        # Set to wake the writer thread up when shutting down
+        self.stopping = threading.Event()
+        self.writer_thread = None
+
+        # Add logger
+        self.logger = logger
+
+    def read(self):
+        '''Returns the persisted token, or None if there isn't one'''
+
+        if os.path.isfile(self.token_file) == False:
+            return None
+
+        with open(self.token_file, 'r') as token_file:
+            token = token_file.read().strip()
+
+        if len(token) == 0:
+            return None
+
+        with self.lock:
+            self.token = token
+            self.written_token = token
+
+        return token
+
+    def update(self, token):
+        '''Takes the latest token, it will be written by the writer thread'''
+
+        with self.lock:
+            self.token = token
+
+    def start(self):
+        '''Starts the writer thread'''
+
+        self.writer_thread = threading.Thread(target=self.writer, daemon=True)
+        self.writer_thread.start()
+
+    def writer(self):
+        '''Writes the token to disk every write interval if it has changed,
+        and once more when stopping'''
+
+        while self.stopping.wait(self.write_interval) == False:
+            self.flush()
+
+        self.flush()
+
+    def flush(self):
+        '''Writes the token to disk now if it has changed. The token is copied
+        under the lock and written outside of it, so the listener never waits
+        on the disk. Only one thread writes: the writer thread, or close if
+        it was never started.'''
+
+        with self.lock:
+            token = self.token
+
+            if token is None or token == self.written_token:
+                return
+
+        # Write to a temporary file and rename it over the old one, so
+        # that a crash mid-write can't leave a truncated token behind
+        temp_file = f'{self.token_file}.tmp'
+
+        try:
+            with open(temp_file, 'w') as token_file:
+                token_file.write(token)
+                token_file.flush()
+                os.fsync(token_file.fileno())
+
+            os.replace(temp_file, self.token_file)
+
+        except OSError as error:
+            self.logger.error(f'Failed to write next batch token: {error}')
+            return
+
+        with self.lock:
+            self.written_token = token
+
+        self.logger.debug(f'Wrote next batch token {token}')
+
+    def close(self):
+        '''Stops the writer thread, writing the latest token on the way out'''
+
+        self.stopping.set()
+
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+
+        else:
+            self.flush()
@@ -1,3 +1,5 @@
+import threading
+from collections import deque
 import bartleby.configuration as conf
 
 class User:
@@ -20,6 +22,10 @@ class User:
         # Start messages list with default prompt
         self.messages = [{'role': 'system', 'content': self.initial_prompt}]
 
+        # Incremented whenever the conversation is restarted, so that
+        # anything cached from the old conversation can be recognized
+        self.conversation_id = 0
+
         # Set default decoding mode from config file
         self.decoding_mode = conf.default_decoding_mode
 
@@ -29,15 +35,74 @@ class User:
         # N most recent messages to include when prompting the model
         self.model_input_buffer_size = conf.model_input_buffer_size
 
+        # Model replica holding this user's cached key values, the
+        # scheduler sends them back to it while the cache lasts
+        self.replica = None
+
+        # Guards the chat history, the listeners add messages
+        # while the generator reads it
+        self.lock = threading.Lock()
+
+        # Pending job slot: set while the user has a generation queued
+        # but not started, new messages are picked up by that generation.
+        # Running is set while generating, the user isn't scheduled
+        # again until it's done.
+        self.generation_pending = False
+        self.generation_running = False
+
+        # Cancellation events for the user's queued and running
+        # generations, set to stop them
+        self.pending_cancellation = None
+        self.running_cancellation = None
+
+        # What the scheduler charged for the running generation, given
+        # back if it's requeued
+        self.charged_cost = 0
+
+        # Generated replies waiting to be posted, oldest first
+        self.replies = deque()
+
+        # Partial reply text and the chat message showing it, used
+        # when streaming replies while they are being generated
+        self.partial_reply = None
+        self.stream_message = None
+
     def set_decoding_mode(self):
 
         for key, value in conf.decoding_mode[self.decoding_mode].items():
             setattr(self.generation_configurations[self.model_type], key, value)
 
+    def add_message(self, role, content):
+        '''Adds a message to the chat history'''
+
+        with self.lock:
+            self.messages.append({'role': role, 'content': content})
+
+    def cancel_generation(self):
+        '''Cancels the user's queued and running generations. Returns True
+        if there was anything to cancel.'''
+
+        cancelled = False
+
+        for cancellation in (self.pending_cancellation, self.running_cancellation):
+            if cancellation is not None and cancellation.is_set() == False:
+                cancellation.set()
+                cancelled = True
+
+        return cancelled
+
     def restart_conversation(self):
-        
-        # Start messages list with default prompt
-        self.messages = [{'role': 'system', 'content': self.initial_prompt}]
+
+        # Any reply in the works is for the old conversation
+        self.cancel_generation()
+
+        with self.lock:
+
+            # Start messages list with default prompt
+            self.messages = [{'role': 'system', 'content': self.initial_prompt}]
+
+            # Mark anything cached from the old conversation as stale
+            self.conversation_id += 1
 
 
 #############################################################################79
\ No newline at end of file
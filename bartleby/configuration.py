@@ -46,6 +46,20 @@ matrix_server_url=matrix.matrix_server_url
 matrix_bot_username=matrix.matrix_bot_username
 matrix_bot_password=matrix.matrix_bot_password
 
+# Point the matrix client at another homeserver than the one in the credentials
+if 'BARTLEBY_MATRIX_SERVER_URL' in os.environ:
+    matrix_server_url=os.environ['BARTLEBY_MATRIX_SERVER_URL']
+
+# Matrix long-poll sync timeout in milliseconds: the server holds each sync
+# open until there are new events or the timeout runs out. Failed syncs
+# are retried after the retry delay in seconds.
+matrix_sync_timeout=30000
+matrix_sync_retry_delay=5
+
+# The next batch token is written to disk in the background when it changes,
+# at most once per write interval in seconds, and again on shutdown
+next_batch_token_write_interval=10
+
 # Discord stuff
 bot_token = discord.token
 
@@ -53,17 +67,144 @@ bot_token = discord.token
 docx_template_file='blank_template.docx'
 default_title='Bartleby Text'
 
+# Documents are built in memory and uploaded straight from there. Set
+# archive documents to also keep a copy of each in the documents
+# directory, named with the title, time and a unique suffix
+archive_documents=False
+
+# Documents are built and uploaded to Google Drive by a pool of background
+# workers, so chat doesn't wait on them. Uploads which fail with a transient
+# error are retried up to the retry limit, waiting the retry delay in seconds
+# before the first retry and doubling it for each one after that
+document_workers=4
+document_upload_retries=5
+document_retry_delay=2
+
+# Users allowed to export other users' chat histories with --export-docx,
+# by user name as it appears in the logs
+admin_users=[]
+
+# Each document worker keeps its own Google Drive client and HTTP connection.
+# Documents larger than the resumable threshold in bytes are uploaded in
+# chunks of the chunk size, which must be a multiple of 256 KB. The API
+# endpoint can point at another server, e.g. the local fake Drive in
+# tests/test_drive_upload.py, which also wants anonymous credentials since
+# it won't check them.
+drive_http_timeout=60
+drive_resumable_threshold=5 * 1024 * 1024
+drive_upload_chunk_size=1024 * 1024
+drive_api_endpoint=None
+drive_anonymous_credentials=False
+
 # Model stuff
 default_model_type='tiiuae/falcon-7b-instruct'
 initial_prompt='You are a friendly chatbot who always responds in the style of Bartleby the scrivener; a depressed and beleaguered legal clerk from the mid 1800s.'
 
 # Some system settings for generation
 device_map='cuda:0'
+
+# Devices to run models on, each gets its own generation worker. Models
+# listed in model placement always go on the given device, others go
+# on the device with the least memory committed to other models
+devices=[device_map]
+model_placement={}
+
+# Number of replicas to run for hot models, e.g. {default_model_type: 2}.
+# Replicas go one per device, so there can be at most as many as there
+# are devices, and only one for models with a fixed placement. Queued
+# users go to whichever replica is free first. Users with cached key
+# values on a replica stick to it unless they have waited longer than
+# the sticky wait in seconds.
+# Queue depth and replica utilisation are logged every stats interval.
+model_replicas={}
+replica_sticky_wait=1.0
+replica_stats_log_interval=60
+
 model_quantization = 'four bit'
 CPU_threads=10
+
+# Settings for models placed on 'cpu', e.g. overflow capacity on CPU only
+# nodes. Four bit quantization needs a GPU, so CPU models use 'int8' dynamic
+# quantization of their linear layers, 'bf16' weights or None for full
+# precision. Torch's thread pools are sized once at startup: CPU threads
+# for work inside each operation and interop threads for running
+# operations in parallel. CPU memory budget in GB is the per device
+# budget for resident models on 'cpu', like the GPU memory budget below.
+# There are no peak memory stats on the CPU, so the process's resident
+# memory is sampled every sample interval in seconds while generating.
+CPU_quantization='int8'
+CPU_interop_threads=2
+CPU_memory_budget=32
+CPU_memory_sample_interval=0.05
 model_input_buffer_size=5
 max_new_tokens=64
 
+# Models are loaded in the background by this many threads. Models
+# in the pre-warm list are loaded at startup, others are loaded the
+# first time a user asks for them
+model_loader_workers=1
+prewarm_models=[default_model_type]
+
+# A model which fails to load is loaded again up to this many times. After
+# that, users waiting for it are taken out of the queue and told.
+model_load_retries=2
+
+# GPU memory budget in GB per device for resident models. When loading a model would
+# go over budget, the least recently used models are evicted. Eviction
+# target 'cpu' moves weights to system memory, 'disk' drops them to be
+# reloaded from the HuggingFace cache. Quantized models always go to disk
+gpu_memory_budget=10
+model_eviction_target='disk'
+
+# Batching settings for the generator. Queued users which share a model
+# type and generation configuration are prompted together in one call
+# to generate. Max batch wait is the time in seconds the scheduler will
+# hold the first queued user while waiting for others to join the batch
+max_batch_size=8
+max_batch_wait=0.05
+
+# The scheduler serves the user who has received the least generation work
+# first. Work is estimated as num_beams * max_new_tokens plus the prompt
+# tokens weighted by the prompt token cost, since prefill is much cheaper
+# per token than decoding
+prompt_token_cost=0.1
+
+# Cancel a user's running generation when they send another message, so
+# that the next generation answers everything they said instead
+cancel_on_follow_up=False
+
+# Streaming mode posts a placeholder reply as soon as the first tokens
+# are generated, then edits it in place as more text arrives. Update
+# interval is the minimum time in seconds between edits
+stream_responses=False
+stream_update_interval=1.0
+
+# Reuse of key values from each user's previous turn, so that only
+# new messages need to be prefilled. Memory budget is in GB across
+# all users of a model, least recently used users are evicted first.
+# Cache device None keeps the cache on the model's device, 'cpu'
+# offloads it to system memory between turns
+kv_cache=True
+kv_cache_memory_budget=2
+kv_cache_device=None
+
+# Max number of system prompts per model to keep prefilled key values for.
+# The default prompt is shared by most users, users who set their own
+# prompt get their own entry
+prompt_cache_max_entries=16
+
+# Batching settings for the system agent's T5 models. These run off
+# of the listener's event loop on a worker thread, which classifies
+# messages which arrive within max batch wait seconds of each other
+# in one pass
+system_agent_max_batch_size=8
+system_agent_max_batch_wait=0.02
+
+# Latency histogram bucket edges in seconds and how many calls
+# between logging the histogram
+latency_histogram_buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+latency_histogram_log_interval=20
+
 # Length penalty defaults for short and long outputs
 # These are selected at run time by the agent
 long_start_index=int(max_new_tokens) * 0.75
@@ -136,17 +277,48 @@ dialo_family_models=[
     'microsoft/DialoGPT-large'
 ]
 
+# Token budget for each model's input. The system prompt is always kept,
+# then messages are added newest first until the budget is used up. The
+# user's model input buffer size still caps the number of messages.
+context_token_budgets={
+    'HuggingFaceH4/zephyr-7b-beta': 2048,
+    'tiiuae/falcon-7b-instruct': 1536,
+    'microsoft/DialoGPT-small': 512,
+    'microsoft/DialoGPT-medium': 512,
+    'microsoft/DialoGPT-large': 512
+}
+
+default_context_token_budget=1024
+
+# Assisted decoding: a small draft model proposes a few tokens at a time and
+# the main model checks them all in one pass, keeping the ones it agrees
+# with. Only used for single user batches without beam search. Draft models
+# have to share the main model's tokenizer, models with no draft model
+# listed generate as usual. Acceptance rate and tokens/sec are logged.
+assisted_decoding=False
+num_assistant_tokens=5
+
+draft_models={
+    'microsoft/DialoGPT-medium': 'microsoft/DialoGPT-small',
+    'microsoft/DialoGPT-large': 'microsoft/DialoGPT-small'
+}
+
 
 # Command documentation to post in chat when asked
 commands = '''\n<b>Available commands:</b>\n\n
 <b>--commands</b>                Posts this message to chat.
-<b>--input-buffer-size</b>       Post size of LLM input buffer.
+<b>--input-buffer-size</b>       Post size of LLM input buffer: the most 
+<b></b>                          recent messages used as model input after 
+<b></b>                          the system prompt, within the model's 
+<b></b>                          token budget.
 <b>--set-input-buffer-size N</b> Updates LLM input buffer to N messages.
-<b>--input-messages</b>          Posts content of LLM input buffer.
+<b>--input-messages</b>          Posts the messages the model will take 
+<b></b>                          as input, system prompt included.
 <b>--prompt</b>                  Post the current system prompt to chat.
 <b>--set-prompt PROMPT</b>       Updates the system prompt to PROMPT and 
 <b></b>                          restarts chat history.
 <b>--reset-chat</b>              Clears and restarts chat history.
+<b>--cancel</b>                  Cancels the reply being generated.
 <b>--decoding-mode</b>           Posts the current decoding mode.
 <b>--decoding-modes</b>          Posts available decoding mode presets.
 <b>--set-decoding-mode X</b>     Sets decoding mode to X preset.
@@ -166,4 +338,7 @@ commands = '''\n<b>Available commands:</b>\n\n
 <b></b>                          upload. 
 <b>--make-docx</b>               Makes and uploads docx document to 
 <b></b>                          Google Drive from last message.
+<b>--export-docx</b>             Makes and uploads a docx document for 
+<b></b>                          each reply in the chat history. Admins 
+<b></b>                          can add user names, or 'all'.
 '''
\ No newline at end of file
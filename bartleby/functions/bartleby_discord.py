@@ -39,11 +39,13 @@ def start_discord_logger():
 
 def discord_listener(
     bot_token,
-    docx_instance,
+    document_queue,
     users,
     llms,
     generation_queue,
     response_queue,
+    stream_queue,
+    notification_queue,
     logger
 ):
     # Start system agent
@@ -58,7 +60,7 @@ def discord_listener(
     intents.members=True
     intents.typing=False
     intents.presences=True
-    client=discord_class.LLMbot(logger, response_queue, users, docx_instance, command_prefix='/', intents=intents)
+    client=discord_class.LLMbot(logger, response_queue, stream_queue, notification_queue, users, llms, document_queue, command_prefix='/', intents=intents)
 
     @client.event
     async def on_ready():
@@ -152,7 +154,11 @@ def discord_listener(
                 # Check to see if it's a command message, if so, send it to the command parser
                 if user_message[:2] == '--' or user_message[:1] == '–':
 
-                    result = command_funcs.parse_command_message(docx_instance, users[user_name], user_message)
+                    # Keep the message object, document jobs reply
+                    # to it when they are done
+                    users[user_name].message_object=message
+
+                    result = command_funcs.parse_command_message(document_queue, llms, users, users[user_name], user_message)
                     result = result.replace('        \r  <b>', '')
                     result = result.replace('</b>', '')
                     result = result.replace('<b>', '')
@@ -165,14 +171,17 @@ def discord_listener(
                 # If it's not a --command, send it to the system agent
                 else:
 
-                    # Check to see if the user's message translates to a known command
-                    command = system_agent_instance.translate_command(user_message)
+                    # Check to see if the user's message translates to a known command,
+                    # the system agent also picks short or long output in the same pass
+                    command, output_size = await system_agent_instance.classify(user_message)
 
                     # If the user message translates to a command send it to the
                     # system agent's parser for execution
                     if command != 'None':
 
-                        result = command_funcs.parse_system_agent_command(docx_instance, users[user_name], command)
+                        users[user_name].message_object=message
+
+                        result = command_funcs.parse_system_agent_command(document_queue, users[user_name], command)
                         result = result.replace('        \r  <b>', '')
                         result = result.replace('</b>', '')
                         result = result.replace('<b>', '')
@@ -187,18 +196,13 @@ def discord_listener(
                     # in the LLM queue for a response
                     else:
 
-                        users[user_name].messages.append({
-                            'role': 'user',
-                            'content': user_message
-                        })
+                        users[user_name].add_message('user', user_message)
 
                         # Add the message object and time for easy parsing later on
                         users[user_name].message_object=message
                         users[user_name].message_time=message_time
 
-                        # Use system agent to pick short or long output and set the corresponding parameters
-                        output_size = system_agent_instance.select_output_size(user_message)
-
+                        # Set the parameters corresponding to the short or long output picked by the system agent
                         if users[user_name].decoding_mode == 'beam_search':
 
                             if output_size == 'long response':
@@ -242,11 +246,12 @@ def discord_listener(
         # If they have, make the document
         if users[user_name].gdrive_folder_id != None:
             
-            # Make the document
-            docx_instance.generate_from_text(users[user_name], text)
+            # Queue the document, the file ID is posted as
+            # a follow up to the interaction when it's done
+            result = document_queue.submit_text(users[user_name], text, interaction)
             
             # Post the reply and log the interaction
-            await interaction.response.send_message(f'```Document generated```')
+            await interaction.response.send_message(f'```{result}```')
             logger.debug(f'Got make docx command from: {user_name}')
 
         # If they have not set a gdrive folder id, ask them to set one
@@ -2,7 +2,7 @@ import asyncio
 import time
 import discord
 from discord import app_commands
-from nio import RoomMessageText
+from nio import RoomMessageText, SyncError
 
 import bartleby.configuration as conf
 import bartleby.functions.command_parsing_functions as command_funcs
@@ -13,36 +13,78 @@ import bartleby.classes.system_agent_class as system_agent
 import bartleby.classes.discord_class as discord_class
 
 # Wrapper function to start the matrix listener loop via asyncIO in a thread
-def matrix_listener(docx_instance, matrix_instance, users, llms, generation_queue, response_queue, logger):
-    asyncio.run(matrix_listener_loop(docx_instance, matrix_instance, users, llms, generation_queue, response_queue, logger))
+def matrix_listener(document_queue, matrix_instance, users, llms, generation_queue, response_queue, stream_queue, notification_queue, logger):
+    try:
+        asyncio.run(matrix_listener_loop(document_queue, matrix_instance, users, llms, generation_queue, response_queue, stream_queue, notification_queue, logger))
+
+    # Write the latest next-batch token if the listener goes down
+    finally:
+        matrix_instance.next_batch_token_store.close()
 
 async def matrix_listener_loop(
-    docx_instance, 
+    document_queue, 
     matrix_instance, 
     users, 
     llms, 
     generation_queue, 
     response_queue, 
+    stream_queue,
+    notification_queue,
     logger
 ):
     '''Watches for messages from users in the matrix room, when it finds
-    one, handles routing that user to an LLM'''
+    one, handles routing that user to an LLM. Posts replies from the LLM
+    as soon as they are ready.'''
 
     system_agent_instance = system_agent.System_agent(logger) 
 
+    # Bind the response, stream and notification queues to this event loop
+    response_queue.attach(asyncio.get_running_loop())
+    stream_queue.attach(asyncio.get_running_loop())
+    notification_queue.attach(asyncio.get_running_loop())
+
     # Log bot into the matrix server and post a hello
     _ = await matrix_instance.async_client.login(matrix_instance.matrix_bot_password)
     _ = await matrix_instance.post_system_message('Bartleby online. Send "--commands" to see a list of available control commands or just say "Hi!".', '')
-    
+
+    # Run the sync consumer and the reply posters side by side, so that
+    # replies don't wait for the long-poll sync to return
+    await asyncio.gather(
+        sync_consumer(document_queue, matrix_instance, system_agent_instance, users, llms, generation_queue, logger),
+        response_poster(matrix_instance, response_queue, logger),
+        stream_poster(matrix_instance, stream_queue, logger),
+        notification_poster(matrix_instance, notification_queue, logger)
+    )
+
+async def sync_consumer(
+    document_queue,
+    matrix_instance,
+    system_agent_instance,
+    users,
+    llms,
+    generation_queue,
+    logger
+):
+    '''Long-polls the matrix server for new events and handles
+    messages from users'''
+
     # Loop like this forever
     while True:
 
-        # Poll the matrix server and wait 0 milliseconds for new events
-        sync_response = await matrix_instance.async_client.sync(timeout=0)
+        # Poll the matrix server, the server holds the request open until
+        # there are new events or the timeout in milliseconds runs out
+        sync_response = await matrix_instance.async_client.sync(timeout=conf.matrix_sync_timeout)
+
+        # If the sync failed, back off for a bit before trying again
+        # rather than hammering the server
+        if isinstance(sync_response, SyncError):
+            logger.error(f'Matrix sync failed: {sync_response.message}')
+            await asyncio.sleep(conf.matrix_sync_retry_delay)
+            continue
 
-        # Write the next-batch token to a file here for the next restart
-        with open(matrix_instance.next_batch_token_file, 'w') as next_batch_token:
-            next_batch_token.write(sync_response.next_batch)
+        # Hand the next-batch token to the token store, it's written
+        # to disk in the background for the next restart
+        matrix_instance.next_batch_token_store.update(sync_response.next_batch)
 
         # Check to make sure that the bot has been joined to the room
         if matrix_instance.matrix_room_id in sync_response.rooms.join:
@@ -50,65 +92,134 @@ async def matrix_listener_loop(
             # Get events in the room
             for event in sync_response.rooms.join[matrix_instance.matrix_room_id].timeline.events:
                 matrix_instance.logger.debug(f'{event.source}')
-                
-                # If the event is a message and mentions bartleby...
-                if isinstance(event, RoomMessageText) and event.source['content']['body'].lower().find('bartleby: ') == 0:
-
-                    # Get the username
-                    user_name = event.sender.split(':')[0][1:]
-
-                    # Deal with initializing the user and/or their LLM as needed
-                    message_time=helper_funcs.setup_user(logger, user_name, users, llms)
-
-                    # Get body of user message
-                    user_message = await matrix_instance.catch_message(event)
-                    logger.debug(f'+{round(time.time() - message_time, 2)} s: User message: {user_message}')
-
-                    # Check to see if it's a command message, if so, send it to the command parser
-                    if user_message[:2] == '--' or user_message[:1] == '–':
-
-                        result = command_funcs.parse_command_message(docx_instance, users[user_name], user_message)
-                        _ = await matrix_instance.post_system_message(result, user_name)
-
-                    # If it's not a --command, send it to the system agent
-                    else:
-
-                        # Check to see if the user's message translates to a known command
-                        command = system_agent_instance.translate_command(user_message)
-
-                        # If the user message translates to a command send it to the
-                        # system agent's parser for execution
-                        if command != 'None':
-
-                            result = command_funcs.parse_system_agent_command(docx_instance, users[user_name], command)
-                            _ = await matrix_instance.post_system_message(result, user_name)
-                            
-                        # If the users message does not translate to a command, add it
-                        # to their message history and send them to the model for inference
-                        elif command == 'None':
-
-                            users[user_name].messages.append({
-                                'role': 'user',
-                                'content': user_message
-                            })
-
-                            # Put the user into the llm's queue
-                            generation_queue.put(users[user_name])
-                            logger.info(f't = {round(time.time() - message_time, 2)}: Added {user_name} to generation queue')
-
-        # Check to see if there are any users with generated responses in the
-        # Response queue, if so, post to chat.
-        #
-        # NOTE: documentation says, "Similarly, if empty() returns False it doesn’t 
-        # guarantee that a subsequent call to get() will not block."
-        # Not sure when/why that would happen...
-        if response_queue.empty() == False:
-
-            # Get the next user from the responder queue
-            queued_user = response_queue.get()
-            logger.info(f'+{round(time.time() - message_time, 2)} s: Responder got {queued_user.user_name} from generator')
-
-            # Post the new response from the users conversation
-            _ = await matrix_instance.post_message(queued_user)
-            response_queue.task_done()
-            logger.info(f'+{round(time.time() - message_time, 2)} s: Posted reply to {queued_user.user_name} in chat')
+
+                await handle_event(document_queue, matrix_instance, system_agent_instance, users, llms, generation_queue, event, logger)
+
+async def handle_event(
+    document_queue,
+    matrix_instance,
+    system_agent_instance,
+    users,
+    llms,
+    generation_queue,
+    event,
+    logger
+):
+    '''Takes an event from the room, if it's a message for bartleby
+    runs the command or sends the user to the LLM'''
+
+    # If the event is a message and mentions bartleby...
+    if isinstance(event, RoomMessageText) and event.source['content']['body'].lower().find('bartleby: ') == 0:
+
+        # Get the username
+        user_name = event.sender.split(':')[0][1:]
+
+        # Deal with initializing the user and/or their LLM as needed
+        message_time=helper_funcs.setup_user(logger, user_name, users, llms)
+
+        # Get body of user message
+        user_message = await matrix_instance.catch_message(event)
+        logger.debug(f'+{round(time.time() - message_time, 2)} s: User message: {user_message}')
+
+        # Check to see if it's a command message, if so, send it to the command parser
+        if user_message[:2] == '--' or user_message[:1] == '–':
+
+            result = command_funcs.parse_command_message(document_queue, llms, users, users[user_name], user_message)
+            _ = await matrix_instance.post_system_message(result, user_name)
+
+        # If it's not a --command, send it to the system agent
+        else:
+
+            # Check to see if the user's message translates to a known
+            # command, matrix doesn't use the output size so skip it
+            command, _ = await system_agent_instance.classify(user_message, size_output = False)
+
+            # If the user message translates to a command send it to the
+            # system agent's parser for execution
+            if command != 'None':
+
+                result = command_funcs.parse_system_agent_command(document_queue, users[user_name], command)
+                _ = await matrix_instance.post_system_message(result, user_name)
+
+            # If the users message does not translate to a command, add it
+            # to their message history and send them to the model for inference
+            elif command == 'None':
+
+                users[user_name].add_message('user', user_message)
+
+                # Put the user into the llm's queue
+                users[user_name].message_time=message_time
+                generation_queue.put(users[user_name])
+                logger.info(f't = {round(time.time() - message_time, 2)}: Added {user_name} to generation queue')
+
+async def response_poster(matrix_instance, response_queue, logger):
+    '''Waits on the response queue and posts each generated reply as soon
+    as it arrives. Replies are posted concurrently.'''
+
+    # Hold references to running posts so they are not garbage collected
+    post_tasks = set()
+
+    while True:
+
+        # Get the next user from the responder queue
+        queued_user = await response_queue.get()
+        logger.info(f'+{round(time.time() - queued_user.message_time, 2)} s: Responder got {queued_user.user_name} from generator')
+
+        # Post the new response from the users conversation
+        post_task = asyncio.create_task(post_response(matrix_instance, queued_user, logger))
+        post_tasks.add(post_task)
+        post_task.add_done_callback(post_tasks.discard)
+
+async def post_response(matrix_instance, queued_user, logger):
+    '''Posts a user's generated reply to chat'''
+
+    try:
+        _ = await matrix_instance.post_message(queued_user)
+
+    # Don't let one failed post take down the poster
+    except Exception as error:
+        logger.error(f'Failed to post reply to {queued_user.user_name}: {error}')
+        return
+
+    logger.info(f'+{round(time.time() - queued_user.message_time, 2)} s: Posted reply to {queued_user.user_name} in chat')
+
+async def stream_poster(matrix_instance, stream_queue, logger):
+    '''Waits on the stream queue and posts or updates partial replies
+    as they arrive'''
+
+    while True:
+
+        # Wait for an update, then collect any others which came in
+        # with it. A user can be on the queue more than once, only
+        # the latest text matters
+        streaming_users = [await stream_queue.get()]
+
+        while stream_queue.empty() == False:
+
+            queued_user = stream_queue.get_nowait()
+
+            if queued_user not in streaming_users:
+                streaming_users.append(queued_user)
+
+        # Post or update the partial replies
+        for queued_user in streaming_users:
+
+            try:
+                _ = await matrix_instance.post_partial_message(queued_user)
+
+            except Exception as error:
+                logger.error(f'Failed to post partial reply to {queued_user.user_name}: {error}')
+
+async def notification_poster(matrix_instance, notification_queue, logger):
+    '''Waits on the notification queue and posts messages
+    from the background workers'''
+
+    while True:
+
+        queued_user, notification, _ = await notification_queue.get()
+
+        try:
+            _ = await matrix_instance.post_system_message(notification, queued_user.user_name)
+
+        except Exception as error:
+            logger.error(f'Failed to post notification to {queued_user.user_name}: {error}')
@@ -0,0 +1,115 @@
+import copy
+import time
+import logging
+import bartleby.configuration as conf
+import bartleby.classes.llm_class as llm
+import bartleby.classes.user_class as user
+import bartleby.classes.docx_class as docx
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+def make_chat_history(user_name, num_messages):
+    '''Returns a user with a chat history of alternating user and
+    assistant messages after the system prompt'''
+
+    benchmark_user = user.User(user_name)
+
+    for i in range(num_messages):
+
+        if i % 2 == 0:
+            benchmark_user.add_message('user', f'Message number {i}. Tell me something about the scrivener and his employer, and keep it short.')
+
+        else:
+            benchmark_user.add_message('assistant', f'Reply number {i}. I would prefer not to, though the lawyer on Wall Street seems a patient sort of man.')
+
+    return benchmark_user
+
+def prompt_build_benchmark(logger, model_type = conf.default_model_type, history_lengths = (2, 8, 32, 128, 512), repeats = 20):
+    '''Times building the model input from chat histories of different
+    lengths, re-tokenizing every message each turn versus concatenating
+    token IDs cached on the messages. Only loads the tokenizer. Returns
+    list of history length, uncached and cached time per build in seconds.'''
+
+    # Set up an LLM class instance with just the tokenizer
+    llm_instance = llm.Llm(logger)
+    llm_instance.model_type = model_type
+    llm_instance.load_tokenizer()
+
+    results = []
+
+    for history_length in history_lengths:
+
+        benchmark_user = make_chat_history('benchmark', history_length)
+
+        # Re-tokenize everything each time, starting from messages with no cached IDs
+        uncached_time = 0
+
+        for i in range(repeats):
+            messages = copy.deepcopy(benchmark_user.messages)
+
+            start_time = time.time()
+            _ = llm_instance.build_input_ids(messages)
+            uncached_time += time.time() - start_time
+
+        # Tokenize once, then time building from the cache
+        _ = llm_instance.build_input_ids(benchmark_user.messages)
+
+        start_time = time.time()
+
+        for i in range(repeats):
+            _ = llm_instance.build_input_ids(benchmark_user.messages)
+
+        cached_time = time.time() - start_time
+
+        results.append((history_length, uncached_time / repeats, cached_time / repeats))
+        logger.info(f'{history_length} messages: {round(1000 * uncached_time / repeats, 3)} ms uncached, {round(1000 * cached_time / repeats, 3)} ms cached')
+
+    return results
+
+def document_build_benchmark(logger, worker_counts = (1, 2, 4, 8), num_documents = 200, num_paragraphs = 20, executor_type = 'thread'):
+    '''Times building documents from the cached template on a pool of thread
+    or process workers, for different numbers of workers. Documents are built
+    and serialized, not uploaded. Returns list of worker count and documents
+    per second.'''
+
+    template_bytes = docx.load_template(f'{conf.DOCUMENTS_PATH}/{conf.docx_template_file}')
+
+    # One multi-paragraph body, like a document made from a range of messages
+    benchmark_user = make_chat_history('benchmark', num_paragraphs)
+    body = '\n'.join(message['content'] for message in benchmark_user.messages[1:])
+
+    if executor_type == 'process':
+        executor_class = ProcessPoolExecutor
+
+    else:
+        executor_class = ThreadPoolExecutor
+
+    results = []
+
+    for worker_count in worker_counts:
+        with executor_class(max_workers = worker_count) as executor:
+
+            # Warm up the workers so process start up isn't timed
+            _ = list(executor.map(docx.make_document_bytes, [template_bytes] * worker_count, ['Warm up'] * worker_count, [body] * worker_count))
+
+            start_time = time.time()
+
+            _ = list(executor.map(
+                docx.make_document_bytes,
+                [template_bytes] * num_documents,
+                [f'Benchmark document {i}' for i in range(num_documents)],
+                [body] * num_documents
+            ))
+
+            documents_per_second = num_documents / (time.time() - start_time)
+
+        results.append((worker_count, documents_per_second))
+        logger.info(f'{worker_count} {executor_type} workers: {round(documents_per_second, 1)} documents per second')
+
+    return results
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO)
+    _ = prompt_build_benchmark(logging.getLogger('bartleby.benchmark'))
+    _ = document_build_benchmark(logging.getLogger('bartleby.benchmark'))
+    _ = document_build_benchmark(logging.getLogger('bartleby.benchmark'), executor_type = 'process')
@@ -1,6 +1,6 @@
 import bartleby.configuration as conf
 
-def parse_command_message(docx_instance, user, command_message):
+def parse_command_message(document_queue, llms, users, user, command_message):
     '''Takes a user message that contains a command and runs the 
     command'''
 
@@ -17,28 +17,21 @@ def parse_command_message(docx_instance, user, command_message):
 
     # Show the current LLM input buffer size
     elif command[0] == '--input-buffer-size':
-        result = f'LLM input buffer size: last {user.model_input_buffer_size} messages'
+        result = f'LLM input buffer size: up to {user.model_input_buffer_size} most recent messages after the system prompt, within the model\'s token budget'
 
     # Set the LLM input buffer size
     elif command[0] == '--set-input-buffer-size':
         if len(command) == 2:
 
             user.model_input_buffer_size = int(command[1])
-            result = f'LLM input buffer updated to last {user.model_input_buffer_size} messages'
+            result = f'LLM input buffer updated to up to {user.model_input_buffer_size} most recent messages after the system prompt'
 
         else:
             result = f'Failed to parse buffer size update command'
 
     # Post current contents of LLM input buffer
     elif command[0] == '--input-messages':
-
-        # Select last n messages for input to the model
-        messages = []
-
-        for message in user.messages[-user.model_input_buffer_size:]:
-            messages.append(f"{message['role']}: {message['content']}\n")
-
-        result = '\n' + '\n'.join(messages)
+        result = input_messages(llms, user)
 
     # Post current prompt to chat
     elif command[0] == '--prompt':
@@ -55,6 +48,14 @@ def parse_command_message(docx_instance, user, command_message):
         user.restart_conversation()
         result = 'Chat history cleared and conversation reset'
 
+    # Cancel the user's queued or running generation
+    elif command[0] == '--cancel':
+        if user.cancel_generation() == True:
+            result = 'Generation cancelled'
+
+        else:
+            result = 'Nothing to cancel'
+
     # Show current decoding mode
     elif command[0] == '--decoding-mode':
         result = f'Decoding mode: {user.decoding_mode}'
@@ -115,10 +116,15 @@ def parse_command_message(docx_instance, user, command_message):
 
     # Update model used for generation
     elif command[0] == '--swap-model':
-        if len(command) == 2:
+        if len(command) == 2 and command[1] in conf.supported_models:
+            user.cancel_generation()
             user.model_type = command[1]
             result = f'Switched to {command[1]} model. Next response may be slow if this model type is not already running or in the cache.'
 
+        elif len(command) == 2:
+            supported_models = '\n'.join(conf.supported_models)
+            result = f'New model must be one of:\n{supported_models}'
+
         else:
             result = 'Failed to parse model update command'
 
@@ -147,7 +153,8 @@ def parse_command_message(docx_instance, user, command_message):
         else:
             result = 'Failed to parse Google Drive folder ID update command'
 
-    # Makes and uploads docx document to Google Drive 
+    # Makes and uploads docx document to Google Drive. The document workers
+    # do the work in the background and post the file ID when it's done
     elif command[0] == '--make-docx':
 
         # Check to see that the user has set a gdrive folder id
@@ -157,27 +164,51 @@ def parse_command_message(docx_instance, user, command_message):
             # If it's a bare generate command with no argument, make the
             # document from the last message in the users chat history
             if len(command) == 1:
-                docx_instance.generate(user, 1, None)
+                result = document_queue.submit(user, 1, None)
 
             # If the generate command is followed by one argument, use that
             # to select the message to convert into docx
             elif len(command) == 2:
-                docx_instance.generate(user, int(command[1]), None)
+                result = document_queue.submit(user, int(command[1]), None)
 
             # If the generation command is followed by two arguments
             # select a message range to convert to docx
             elif len(command) == 3:
-                docx_instance.generate(user, int(command[1]), int(command[2]))
+                result = document_queue.submit(user, int(command[1]), int(command[2]))
 
             else:
                 result = 'Failed to parse document generation command'
 
-            result = 'Document generated'
-
         # If they have not set a gdrive folder id, ask them to set one
         # before generating a document
         elif user.gdrive_folder_id == None:
             result = 'Please set a Google Drive folder ID before generating a document for upload'
+
+    # Makes and uploads a document for each reply in the user's chat history.
+    # Admins can export other users' histories by user name, or everyone's.
+    elif command[0] == '--export-docx':
+
+        if user.gdrive_folder_id == None:
+            result = 'Please set a Google Drive folder ID before exporting documents'
+
+        # A bare export command exports the user's own history
+        elif len(command) == 1:
+            result = document_queue.submit_export(user, [user])
+
+        elif str(user.user_name) not in conf.admin_users:
+            result = "Only admins can export other users' chat histories"
+
+        elif command[1] == 'all':
+            result = document_queue.submit_export(user, list(users.values()))
+
+        else:
+            export_users = [export_user for export_user in list(users.values()) if str(export_user.user_name) in command[1:]]
+
+            if len(export_users) == 0:
+                result = f"No chat history for {' '.join(command[1:])}"
+
+            else:
+                result = document_queue.submit_export(user, export_users)
         
     # If we didn't recognize the command, post an error to chat
     else:
@@ -186,7 +217,7 @@ def parse_command_message(docx_instance, user, command_message):
     return result
 
 
-def parse_system_agent_command(docx_instance, user, command):
+def parse_system_agent_command(document_queue, user, command):
 
     if command == 'restart chat':
         user.restart_conversation()
@@ -199,11 +230,11 @@ def parse_system_agent_command(docx_instance, user, command):
         result = f'{user.generation_configurations[user.model_type]}\n'
 
     elif command == 'buffer size':
-        result = f'LLM input buffer size: last {user.model_input_buffer_size} messages'
+        result = f'LLM input buffer size: up to {user.model_input_buffer_size} most recent messages after the system prompt, within the model\'s token budget'
 
     elif 'set input buffer' in command:
         user.model_input_buffer_size = int(command.split(' ')[3])
-        result = f'LLM input buffer updated to last {user.model_input_buffer_size} messages'
+        result = f'LLM input buffer updated to up to {user.model_input_buffer_size} most recent messages after the system prompt'
 
     elif 'output length' in command:
 
@@ -249,10 +280,8 @@ def parse_system_agent_command(docx_instance, user, command):
 
         if user.gdrive_folder_id != None:
 
-            # Make the document from the last message in the users chat history
-            docx_instance.generate(user, 1, None)
-
-            result = 'Document generated'
+            # Queue the document from the last message in the users chat history
+            result = document_queue.submit(user, 1, None)
 
         # If they have not set a gdrive folder id, ask them to set one
         # before generating a document
@@ -266,10 +295,18 @@ def parse_system_agent_command(docx_instance, user, command):
     elif command == 'document title':
         result = f'Document title: {user.document_title}'
 
-    elif command.split(' ')[:2] == 'swap model':
+    elif ' '.join(command.split(' ')[:2]) == 'swap model':
         new_model = command.split(' ')[-1]
-        user.model_type = new_model
-        result = f'Switched to {new_model} model'
+
+        # Check to make sure we have the model the user asked for
+        if new_model in conf.supported_models:
+            user.cancel_generation()
+            user.model_type = new_model
+            result = f'Switched to {new_model} model'
+
+        else:
+            supported_models = '\n'.join(conf.supported_models)
+            result = f'New model must be one of:\n{supported_models}'
 
     elif command == 'commands':
 
@@ -280,3 +317,27 @@ def parse_system_agent_command(docx_instance, user, command):
         result = f'Unrecognized command: {command}'
 
     return result
+
+def input_messages(llms, user):
+    '''Returns the messages the user's model would take as input if
+    prompted now, formatted for chat. Uses the model's own selection,
+    so the listing matches its token budget and the input buffer size.'''
+
+    # Selecting messages needs a tokenizer, so use a loaded replica
+    llm_instance = None
+
+    for replica in llms.request(user.model_type):
+        if replica.ready.is_set() == True:
+            llm_instance = replica
+
+    if llm_instance is None:
+        return f'{user.model_type} is still loading, try again when it is ready'
+
+    with user.lock:
+
+        messages = []
+
+        for message in llm_instance.select_input_messages(user):
+            messages.append(f"{message['role']}: {message['content']}\n")
+
+    return '\n' + '\n'.join(messages)
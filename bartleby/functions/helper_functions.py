@@ -4,7 +4,6 @@ import os
 import time
 import bartleby.configuration as conf
 import bartleby.classes.user_class as user
-import bartleby.classes.llm_class as llm
 from pathlib import Path
 from logging.handlers import RotatingFileHandler
 
@@ -55,18 +54,16 @@ def setup_user(logger, user_name, users, llms):
         users[user_name] = user.User(user_name)
         logger.info(f'+{round(time.time() - message_time, 2)}s: New user: {user_name}')
 
-    # Then check to see if we have a running instance of the user's model type,
-    # if we don't spin one up
-    if users[user_name].model_type not in llms.keys():
+    # Then check to see if we have instances of the user's model type, if we don't
+    # start loading them in the background. The user's generation request waits in
+    # the queue until a replica is ready, without holding up the listener
+    replicas = llms.request(users[user_name].model_type)
 
-        # Instantiate the llm class instance and initialize the model, then
-        # add it to the list of running llms
-        llms[users[user_name].model_type] = llm.Llm(logger)
-        llms[users[user_name].model_type].initialize_model(users[user_name].model_type)
-        logger.info(f"+{round(time.time() - message_time, 2)}s: Initialized {users[user_name].model_type} model for {user_name}")
+    if any(llm_instance.ready.is_set() for llm_instance in replicas):
+        logger.info(f"+{round(time.time() - message_time, 2)}s: Already have {users[user_name].model_type} running for {user_name}")
 
     else:
-        logger.info(f"+{round(time.time() - message_time, 2)}s: Already have {users[user_name].model_type} running for {user_name}")
+        logger.info(f"+{round(time.time() - message_time, 2)}s: {users[user_name].model_type} for {user_name} is loading")
 
     # Check if the user has a configuration set for this type of model
     if users[user_name].model_type not in users[user_name].generation_configurations.keys():
@@ -74,26 +71,70 @@ def setup_user(logger, user_name, users, llms):
         # If not, get the default generation configuration that came from 
         # the model's initialization and give it to the user so they can have their
         # own copy to modify at will
-        model_default_generation_configuration = llms[users[user_name].model_type].default_generation_configuration
+        model_default_generation_configuration = replicas[0].default_generation_configuration
         users[user_name].generation_configurations[users[user_name].model_type] = model_default_generation_configuration
         users[user_name].set_decoding_mode()
         logger.info(f'+{round(time.time() - message_time, 2)}s: Set generation configuration for {user_name} with {users[user_name].decoding_mode} defaults')
 
     return message_time
 
-def generator(llms, generation_queue, response_queue):
-    '''Takes a user from the listener and generates a reply.
-    Sends the reply to the responder.'''
+def generator(logger, llms, generation_queue, response_queue, stream_queue, notification_queue, device):
+    '''Generation worker for one device. Takes batches of users for models on
+    the device from the listener via the scheduler and generates replies. Sends
+    partial replies to the stream queue while generating and the users to the
+    responder when done. Failures are posted to the users in the batch.'''
 
     # Do this forever
     while True:
-        
-        # Get the next user from the generation input queue
-        queued_user = generation_queue.get()
 
-        # Send the user for generation
-        _ = llms[queued_user.model_type].prompt_model(queued_user)
-        generation_queue.task_done()
+        batch = []
+
+        # Don't let a failed batch take down the worker, tell the users instead
+        try:
+
+            # Get the next batch of users which can share a call to the model
+            batch = generation_queue.next_batch(llms, device)
+
+            # Mark the model's replica on this device as in use so it
+            # is not evicted while generating
+            llm_instance = llms.checkout(batch[0].model_type, device)
+
+            # If the model was evicted since the batch was scheduled, put the
+            # users back in the queue to wait for it to be restored
+            if llm_instance is None:
+                generation_queue.requeue(batch)
+                continue
+
+            # Send the batch for generation
+            try:
+                completed_users = llm_instance.prompt_model_batch(batch, stream_queue)
+
+            finally:
+                llms.checkin(llm_instance)
+                generation_queue.finish(batch)
+
+        except Exception as error:
+            logger.error(f'Generation on {device} failed: {error}')
+
+            for queued_user in batch:
+                notification_queue.put((queued_user, f'Sorry, generation failed: {error}', None))
+
+                # Have the responder take down any partial reply,
+                # like for a cancelled generation
+                if stream_queue is not None:
+                    queued_user.replies.append(None)
+                    response_queue.put(queued_user)
+
+            continue
+
+        # Remember which replica has the users' cached key values
+        for queued_user in batch:
+            queued_user.replica = llm_instance
+
+        # Log queue depth and replica utilisation now and then
+        llms.log_stats(generation_queue.depth())
 
-        # Send the user to responder to post the LLM's response
-        response_queue.put(queued_user)
\ No newline at end of file
+        # Send the users to responder to post the LLM's responses, or
+        # take down partial replies from cancelled generations
+        for queued_user in completed_users:
+            response_queue.put(queued_user)
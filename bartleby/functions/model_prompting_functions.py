@@ -1,131 +1,148 @@
-import torch
+import bartleby.configuration as conf
 
-def prompt_mistral(input_messages, device_map, model, tokenizer, generation_configuration):
+def tokenize_message(model_type, message, tokenizer):
+    '''Tokenizes one message the way it appears in the model input,
+    returns list of token IDs. The model input is the concatenation
+    of its messages' token IDs, followed by the generation prompt.'''
 
-    # Tokenize the updated conversation
-    prompt = tokenizer.apply_chat_template(
-        input_messages,
-        tokenize = True,
-        add_generation_prompt = True,
-        return_tensors = 'pt'
-    )
-    
-    # Select device
-    if device_map != 'cpu':
-        prompt=prompt.to('cuda')
-
-    # Generate response
-    output_ids = model.generate(
-        prompt,
-        generation_config = generation_configuration
-    )
+    # Mistral
+    if model_type in conf.mistral_family_models:
 
-    # Un-tokenize response
-    model_output = tokenizer.batch_decode(
-        output_ids,
-        skip_special_tokens = True,
-        clean_up_tokenization_spaces = False
-    )
+        # The chat template renders each message on its own, so render just this one
+        text = tokenizer.apply_chat_template(
+            [{'role': message['role'], 'content': message['content']}],
+            tokenize = False,
+            add_generation_prompt = False
+        )
 
-    # Get number of tokens generated for logging
-    num_tokens_generated = output_ids.size()[1] - prompt.size()[1]
+        # The system prompt starts the input, everything else follows a newline
+        if message['role'] == 'system':
+            token_ids = tokenizer(text, add_special_tokens=False)['input_ids']
 
-    # Parse model's response
-    model_output_content = model_output[0]
-    reply = model_output_content.split('\n<|assistant|>\n')[-1]
+        else:
+            token_ids = tokenize_continuation(text, tokenizer)
 
-    return reply, num_tokens_generated
+    # Falcon
+    elif model_type in conf.falcon_family_models:
+        token_ids = tokenizer(f"{message['role']}: {message['content']}\n")['input_ids']
 
-def prompt_falcon(input_messages, device_map, model, tokenizer, generation_configuration, logger):
+    # Dialo
+    elif model_type in conf.dialo_family_models:
+        token_ids = tokenizer.encode(message['content'])
 
-    # Empty list to hold parsed and formatted messages
-    messages = []
+    return token_ids
 
-    # Format messages for input to falcon
-    for message in input_messages:
-        
-        if message['role'] == 'system': 
-            messages.append(f"system: {message['content']}")
+def tokenize_generation_prompt(model_type, tokenizer):
+    '''Tokenizes the text which ends the model input and prompts a reply
+    from the model, returns list of token IDs'''
 
-        elif message['role'] == 'user': 
-            messages.append(f"user: {message['content']}")
+    # Mistral
+    if model_type in conf.mistral_family_models:
 
-        elif message['role'] == 'assistant': 
-            messages.append(f"assistant: {message['content']}")
+        # Find the generation prompt text by rendering a message with and without it
+        message = [{'role': 'user', 'content': ''}]
 
-    # Add a final 'assistant:' line with no message to prompt reply from model
-    messages.append('assistant:')
+        text_without_prompt = tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=False)
+        text_with_prompt = tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
 
-    # Collect messages from list into string
-    input = '\n'.join(messages)
+        token_ids = tokenize_continuation(text_with_prompt[len(text_without_prompt):], tokenizer)
 
-    # Tokenize the input messages
-    inputs = tokenizer(input, return_tensors='pt')
+    # Falcon, a final 'assistant:' line with no message prompts reply from model
+    elif model_type in conf.falcon_family_models:
+        token_ids = tokenizer('assistant:')['input_ids']
 
-    # Select device
-    if device_map != 'cpu':
-        inputs=inputs.to('cuda')
+    # Dialo, end-of-sequence as last 'message' in input
+    elif model_type in conf.dialo_family_models:
+        token_ids = [tokenizer.eos_token_id]
 
-    logger.debug(generation_configuration)
+    return token_ids
 
-    # Generate the response
-    output_ids = model.generate(
-        **inputs, 
-        eos_token_id=tokenizer.eos_token_id,
-        pad_token_id=tokenizer.eos_token_id,
-        generation_config = generation_configuration,
-        num_return_sequences = 1
-    )
+def tokenize_continuation(text, tokenizer):
+    '''Tokenizes text as it appears after a newline in the middle of the
+    model input, rather than at the start where sentencepiece tokenizers
+    add a leading space. Returns list of token IDs.'''
 
-    # Get total number of tokens generated for logging
-    num_tokens_generated = output_ids.size()[1]
+    newline_ids = tokenizer('\n', add_special_tokens=False)['input_ids']
+    token_ids = tokenizer('\n' + text, add_special_tokens=False)['input_ids']
 
-    # Un-tokenize the response
-    reply = tokenizer.batch_decode(output_ids, eos_token_id=tokenizer.eos_token_id)
-    logger.debug(f'Raw reply: {reply}')
+    return token_ids[len(newline_ids):]
 
-    # Fence to catch index errors in reply parse caused by empty response
-    try:
-        # Parse the reply
-        reply = reply[0]
-        reply = reply.split('\n')
-        reply = reply[len(input_messages)]
-        reply = reply.replace('assistant: ', '')
-        reply = reply.replace('<|endoftext|>', '')
+def pad(batch_input_ids, tokenizer):
+    '''Takes list of token ID lists, returns left padded batch of input
+    IDs and attention mask'''
+
+    inputs = tokenizer.pad({'input_ids': batch_input_ids}, padding=True, return_tensors='pt')
 
-    except IndexError as e:
-        reply = ''
+    return inputs
 
-    return reply, num_tokens_generated
+def tokenize_system_prompt(model_type, prompt, tokenizer):
+    '''Tokenizes a system prompt the way it appears at the start of a
+    conversation for the model family, returns list of token IDs'''
 
-def prompt_dialo(input_messages, device_map, model, tokenizer):
-    # Collect and encode chat history
+    return tokenize_message(model_type, {'role': 'system', 'content': prompt}, tokenizer)
 
-    # Empty holder for tokenized messages
-    tokenized_messages = []
+def generation_arguments(model_type, tokenizer, generation_configuration):
+    '''Returns model family specific keyword arguments for model.generate'''
 
-    # Add end-of-sequence as last 'message' in input
-    input_messages.append({'content': tokenizer.eos_token})
+    # Mistral
+    if model_type in conf.mistral_family_models:
+        arguments = {
+            'pad_token_id': tokenizer.pad_token_id,
+            'generation_config': generation_configuration
+        }
 
-    # Tokenize the messages
-    for message in input_messages:
-        tokenized_message = tokenizer.encode(message['content'], return_tensors='pt')
-        tokenized_messages.append(tokenized_message)
+    # Falcon
+    elif model_type in conf.falcon_family_models:
+        arguments = {
+            'eos_token_id': tokenizer.eos_token_id,
+            'pad_token_id': tokenizer.pad_token_id,
+            'generation_config': generation_configuration,
+            'num_return_sequences': 1
+        }
 
-    # Concatenate tokenized chat messages
-    inputs = torch.cat(tokenized_messages, dim=-1)
+    # Dialo uses the model's own generation configuration
+    elif model_type in conf.dialo_family_models:
+        arguments = {
+            'max_length': 1000,
+            'pad_token_id': tokenizer.pad_token_id
+        }
 
-    # Select device
-    if device_map != 'cpu':
-        inputs=inputs.to('cuda')
+    return arguments
 
-    # Generate response
-    output_ids = model.generate(inputs, max_length=1000, pad_token_id=tokenizer.eos_token_id)
+def decode_replies(model_type, tokenizer, input_ids, output_ids):
+    '''Takes the batch of prompt and output token IDs, returns the parsed
+    reply and number of tokens generated for each row in the batch'''
 
-    # Get total number of tokens generated for logging
-    num_tokens_generated = len(output_ids[:, inputs.shape[-1]:][0])
+    # Prompts are left padded, so new tokens for every row start at the
+    # same position: the width of the input batch
+    new_ids = output_ids[:, input_ids.shape[-1]:]
+
+    # Un-tokenize the new tokens
+    raw_replies = tokenizer.batch_decode(
+        new_ids,
+        skip_special_tokens = True,
+        clean_up_tokenization_spaces = False
+    )
+
+    # Parse the replies
+    replies = [parse_reply(model_type, reply) for reply in raw_replies]
+
+    # Count non-padding tokens in each row for logging
+    num_tokens_generated = (new_ids != tokenizer.pad_token_id).sum(dim = -1).tolist()
+
+    return replies, num_tokens_generated
+
+def parse_reply(model_type, reply):
+    '''Cleans up raw model output into reply text'''
+
+    if model_type in conf.falcon_family_models:
+
+        # Falcon tends to keep going and write the next user turn, so keep
+        # only the first line of the new text as the reply
+        reply = reply.strip().split('\n')[0]
+        reply = reply.replace('<|endoftext|>', '')
 
-    # Un-tokenize last response by bot
-    reply = tokenizer.decode(output_ids[:, inputs.shape[-1]:][0], skip_special_tokens=True)
+    else:
+        reply = reply.strip()
 
-    return reply, num_tokens_generated
\ No newline at end of file
+    return reply
@@ -0,0 +1,160 @@
+'''Uploads documents to a fake Google Drive server running on localhost.
+Run with: python -m unittest discover tests, or pytest'''
+
+import os
+import sys
+import json
+import logging
+import threading
+import unittest
+import importlib
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Run from anywhere, not just the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The configuration reads the matrix and discord credentials, which aren't
+# checked in. Nothing here talks to either, so stand the samples in for them.
+for credentials in ('matrix', 'discord_credentials'):
+    if importlib.util.find_spec(f'bartleby.credentials.{credentials}') is None:
+        sys.modules[f'bartleby.credentials.{credentials}'] = importlib.import_module(f'bartleby.credentials.{credentials}_SAMPLE')
+
+import bartleby.configuration as conf
+import bartleby.classes.docx_class as docx
+import bartleby.classes.document_queue_class as document_queue
+
+class Fake_drive(BaseHTTPRequestHandler):
+    '''Just enough of the Drive upload API to take multipart and resumable
+    uploads. Records the requests it gets and can be told to fail some.'''
+
+    # Shared with the test cases, reset by setUp
+    requests = []
+    failures = []
+    received = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers = {}):
+        self.send_response(status)
+
+        for header, value in headers.items():
+            self.send_header(header, value)
+
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        Fake_drive.requests.append(('POST', self.path))
+
+        # Start of a resumable upload, hand out the session URL
+        if 'uploadType=resumable' in self.path:
+            Fake_drive.received = 0
+            self.send_empty(200, {'Location': f'http://127.0.0.1:{self.server.server_address[1]}/upload/session'})
+
+        else:
+            self.send_json(200, {'id': 'multipart_file'})
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_range = self.headers.get('Content-Range')
+        Fake_drive.requests.append(('PUT', content_range))
+
+        # Fail the request if asked to, without keeping the chunk
+        if len(Fake_drive.failures) > 0 and Fake_drive.failures[0] == len(Fake_drive.requests):
+            Fake_drive.failures.pop(0)
+            self.send_json(503, {'error': {'code': 503, 'message': 'Backend error'}})
+            return
+
+        byte_range, total = content_range.split(' ')[1].split('/')
+
+        # A chunk, otherwise the client is asking how far the upload got
+        if byte_range != '*':
+            Fake_drive.received = int(byte_range.split('-')[1]) + 1
+
+        if Fake_drive.received < int(total):
+            headers = {}
+
+            if Fake_drive.received > 0:
+                headers['Range'] = f'bytes=0-{Fake_drive.received - 1}'
+
+            self.send_empty(308, headers)
+
+        else:
+            self.send_json(200, {'id': 'resumable_file'})
+
+class Test_drive_upload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Fake_drive)
+        threading.Thread(target = cls.server.serve_forever, daemon = True).start()
+
+        # No trailing slash, the client should add it
+        conf.drive_api_endpoint = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        conf.drive_anonymous_credentials = True
+        conf.drive_resumable_threshold = 300 * 1024
+        conf.drive_upload_chunk_size = 256 * 1024
+        conf.document_retry_delay = 0
+
+        # Retries are expected, don't print their warnings
+        logger = logging.getLogger(__name__)
+        logger.setLevel(logging.ERROR)
+
+        cls.docx_instance = docx.Docx()
+        cls.document_queue = document_queue.Document_queue(cls.docx_instance, None, logger)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.document_queue.executor.shutdown()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        Fake_drive.requests = []
+        Fake_drive.failures = []
+
+    def test_multipart_upload(self):
+        document = self.docx_instance.build_document('Test', 'Some text')
+        file_id = self.document_queue.upload(document, 'folder', 'Test.docx')
+
+        self.assertEqual(file_id, 'multipart_file')
+        self.assertEqual(len(Fake_drive.requests), 1)
+        self.assertTrue(Fake_drive.requests[0][1].startswith('/upload/drive/v3/files'))
+
+    def test_resumable_upload(self):
+        file_id = self.document_queue.upload(os.urandom(700 * 1024), 'folder', 'Test.docx')
+
+        self.assertEqual(file_id, 'resumable_file')
+        self.assertEqual([method for method, _ in Fake_drive.requests], ['POST', 'PUT', 'PUT', 'PUT'])
+
+    def test_resumable_upload_resumes_after_error(self):
+
+        # Fail the second chunk, the upload should ask where it got to and
+        # carry on from there rather than start a new upload
+        Fake_drive.failures = [3]
+        file_id = self.document_queue.upload(os.urandom(700 * 1024), 'folder', 'Test.docx')
+
+        self.assertEqual(file_id, 'resumable_file')
+        self.assertEqual([method for method, _ in Fake_drive.requests].count('POST'), 1)
+        self.assertEqual(Fake_drive.requests[3][1], 'bytes */716800')
+        self.assertEqual(Fake_drive.requests[4][1], 'bytes 262144-524287/716800')
+
+    def test_upload_gives_up_after_retries(self):
+        Fake_drive.failures = list(range(2, 3 + conf.document_upload_retries))
+
+        with self.assertRaises(document_queue.HttpError):
+            self.document_queue.upload(os.urandom(700 * 1024), 'folder', 'Test.docx')
+
+if __name__ == '__main__':
+    unittest.main()